@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import posixpath
+import random
+import resource
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+
+import ebook_image_extractor
+from ebook_image_extractor import Image
+
+usage = '''Ebook image extractor benchmark.
+    USAGE: python benchmark.py [--books N] [--seed N] [--large-size WxH] [--json] [--keep DIR] [extractor options]
+    Any other option, such as --jobs N, --schedule or --async-io N, is handed to the extractor,
+    whose pipelines are what gets measured
+    '''
+
+ZIP_DATE = (2020, 1, 1, 0, 0, 0) # fixed member dates keep the corpus byte for byte reproducible
+
+VARIANTS = ('opf_in_root', 'oebps_opf', 'guide_cover', 'itemref_cover', 'svg_cover', 'png_cover', 'large_image',
+    'meta_cover', 'properties_cover', 'pdf')
+
+CONTAINER_XML = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="{opf}" media-type="application/oebps-package+xml"/></rootfiles>
+</container>'''
+
+OPF = '''<?xml version="1.0" encoding="UTF-8"?>
+<package version="{version}" unique-identifier="id" xmlns="http://www.idpf.org/2007/opf">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Book {number}</dc:title><dc:identifier id="id">{number}</dc:identifier>{cover_meta}</metadata>
+<manifest>
+<item id="cover" href="{text_dir}cover.xhtml" media-type="application/xhtml+xml"/>
+{chapter_items}
+<item id="cover-image" href="{image_dir}cover.{image_ext}" media-type="{image_type}"{properties}/>
+</manifest>
+<spine>
+<itemref idref="cover"/>
+{chapter_itemrefs}
+</spine>
+{guide}
+</package>'''
+
+GUIDE = '''<guide><reference type="cover" title="Cover" href="{text_dir}cover.xhtml"/></guide>'''
+
+COVER_META = '''<meta name="cover" content="cover-image"/>''' # epub 2 declares the cover image in the metadata
+
+COVER_IMG = '''<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Cover</title></head>
+<body><div><img src="{image_href}" alt="cover"/></div></body></html>'''
+
+COVER_SVG = '''<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:xlink="http://www.w3.org/1999/xlink"><head><title>Cover</title></head>
+<body><svg xmlns="http://www.w3.org/2000/svg" version="1.1" viewBox="0 0 600 800">
+<image width="600" height="800" xlink:href="{image_href}"/></svg></body></html>'''
+
+CHAPTER = '''<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter {number}</title></head>
+<body><p>{text}</p></body></html>'''
+
+def make_png(width, height, rng):
+    '''Encode a png by hand, so the corpus does not depend on Pillow'''
+    def chunk(tag, data):
+        return struct.pack('>L', len(data)) + tag + data + struct.pack('>L', zlib.crc32(tag + data))
+    row = bytes(rng.randrange(256) for _ in range(width * 3))
+    raw = b''.join(b'\x00' + row for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>LLBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+def make_jpeg(width, height, rng):
+    '''A real jpeg with Pillow; otherwise random bytes between jpeg markers, which is enough for a verbatim copy'''
+    if Image is None:
+        return b'\xff\xd8\xff\xe0' + rng.randbytes(width * height // 10) + b'\xff\xd9'
+    image = Image.frombytes('L', (width, height), rng.randbytes(width * height)).convert('RGB')
+    image_file = io.BytesIO()
+    image.save(image_file, 'JPEG', quality=85)
+    return image_file.getvalue()
+
+def make_pdf(number):
+    '''A one page pdf with a line of text, written out with its cross reference table'''
+    stream = b'BT /F1 24 Tf 72 720 Td (Book %d) Tj ET' % number
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        ]
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (i, obj)
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return pdf
+
+def make_epub(book_file, number, variant, rng, large_size=(3000, 4500)):
+    '''Write one synthetic epub exercising the cover resolution path named by variant'''
+    opf = 'content.opf' if variant == 'opf_in_root' else 'OEBPS/content.opf'
+    root = posixpath.dirname(opf)
+    text_dir, image_dir = 'Text/', 'Images/'
+    if variant == 'png_cover':
+        image_ext, image_type = 'png', 'image/png'
+        image_data = make_png(300, 400, rng)
+    else:
+        image_ext, image_type = 'jpg', 'image/jpeg'
+        image_data = make_jpeg(*(large_size if variant == 'large_image' else (600, 800)), rng)
+    chapters = rng.randrange(5, 30)
+    members = {
+        'META-INF/container.xml': CONTAINER_XML.format(opf=opf),
+        opf: OPF.format(number=number, text_dir=text_dir, image_dir=image_dir, image_ext=image_ext, image_type=image_type,
+            version='3.0' if variant == 'properties_cover' else '2.0',
+            cover_meta=COVER_META if variant == 'meta_cover' else '',
+            properties=' properties="cover-image"' if variant == 'properties_cover' else '',
+            chapter_items='\n'.join(f'<item id="c{i}" href="{text_dir}chapter{i}.xhtml" media-type="application/xhtml+xml"/>' for i in range(chapters)),
+            chapter_itemrefs='\n'.join(f'<itemref idref="c{i}"/>' for i in range(chapters)),
+            guide='' if variant == 'itemref_cover' else GUIDE.format(text_dir=text_dir)),
+        posixpath.join(root, text_dir, 'cover.xhtml'): (COVER_SVG if variant == 'svg_cover' else COVER_IMG).format(image_href=f'../{image_dir}cover.{image_ext}'),
+        posixpath.join(root, image_dir, f'cover.{image_ext}'): image_data,
+        }
+    if variant == 'oebps_opf': # no container.xml, so the opf has to be found at its usual location
+        del members['META-INF/container.xml']
+    for i in range(chapters):
+        members[posixpath.join(root, text_dir, f'chapter{i}.xhtml')] = CHAPTER.format(number=i, text=' '.join(['lorem ipsum dolor sit amet'] * rng.randrange(50, 500)))
+    with zipfile.ZipFile(book_file, 'w', zipfile.ZIP_DEFLATED) as epub_archive:
+        epub_archive.writestr(zipfile.ZipInfo('mimetype', ZIP_DATE), 'application/epub+zip', zipfile.ZIP_STORED)
+        for name, data in members.items():
+            epub_archive.writestr(zipfile.ZipInfo(name, ZIP_DATE), data, zipfile.ZIP_STORED if name.endswith('.jpg') else zipfile.ZIP_DEFLATED)
+
+def make_corpus(corpus_dir, books, seed=0, large_size=(3000, 4500)):
+    '''Write a reproducible synthetic library of books cycling through VARIANTS, and return their paths'''
+    rng = random.Random(seed)
+    file_names = []
+    for number in range(books):
+        variant = VARIANTS[number % len(VARIANTS)]
+        if variant == 'pdf':
+            file_name = os.path.join(corpus_dir, f'{number:06d}-{variant}.pdf')
+            with open(file_name, 'wb') as pdf_file:
+                pdf_file.write(make_pdf(number))
+        else:
+            file_name = os.path.join(corpus_dir, f'{number:06d}-{variant}.epub')
+            make_epub(file_name, number, variant, rng, large_size)
+        file_names.append(file_name)
+    return file_names
+
+def peak_rss():
+    '''Peak resident set size in MiB of this process or any of its finished children'''
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def run_benchmark(file_names, options=None):
+    '''Run the extractor end to end over file_names, through the pipeline options chose, and summarise
+    throughput, latency and memory. options are the extractor's parse_args, by default those of a plain run'''
+    if options is None:
+        options = ebook_image_extractor.parse_args([os.path.dirname(file_names[0])])
+    ebook_image_extractor.configure(ebook_image_extractor.options_config(options))
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            records = list(ebook_image_extractor.extract_images(file_names, options))
+    finally:
+        ebook_image_extractor.close_store()
+        ebook_image_extractor.close_index()
+    elapsed = time.perf_counter() - start
+    latencies = [record['seconds'] for record in records if record['seconds'] is not None] or [0]
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'books': len(file_names),
+        'created': sum(record['status'] == 'created' for record in records),
+        'failed': sum(record['status'] == 'failed' for record in records),
+        'seconds': round(elapsed, 3),
+        'books_per_second': round(len(file_names) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(quantiles[49] * 1000, 2),
+        'p99_ms': round(quantiles[98] * 1000, 2),
+        'peak_rss_mb': round(peak_rss(), 1),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument('--books', type=int, default=400, help='number of books in the corpus')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the corpus generator')
+    parser.add_argument('--large-size', type=ebook_image_extractor.parse_size, default=(3000, 4500), metavar='WxH', help='size of the large cover images')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    parser.add_argument('--keep', metavar='DIR', help='write the corpus to DIR and keep it')
+    options, extractor_args = parser.parse_known_args()
+
+    corpus_dir = options.keep or tempfile.mkdtemp()
+    os.makedirs(corpus_dir, exist_ok=True)
+    try:
+        file_names = make_corpus(corpus_dir, options.books, options.seed, options.large_size)
+        results = run_benchmark(file_names, ebook_image_extractor.parse_args(extractor_args + [corpus_dir]))
+    finally:
+        if not options.keep:
+            shutil.rmtree(corpus_dir)
+    if options.json:
+        print(json.dumps(results))
+    else:
+        print('\n'.join(f'    {key}: {value}' for key, value in results.items()))
+
+if __name__ == '__main__':
+    main()
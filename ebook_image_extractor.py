@@ -1,71 +1,304 @@
 #!/usr/bin/env python
 
-from io import BytesIO
-from lxml import etree
+import argparse
+import base64
+import bisect
+import collections
+import contextlib
+import errno
+import fnmatch
+import hashlib
+import importlib
+import importlib.util
+import io
+import itertools
+import json
+import math
 import os
+import posixpath
 import re
+import select
+import shlex
 import shutil
+import struct
 import subprocess
 import sys
-import time
 import tempfile
+import threading
+import time
+import urllib.parse
 import zipfile
+import zlib
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CHUNK_SIZE = 1024 * 1024
+
+HEADER_SIZE = 1024 # enough of a book to recognise its format
+
+
+FICLONE = 0x40049409 # linux ioctl sharing a file's extents with another, on btrfs and xfs
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg')
+
+config_cfg = {
+    'index': None, # sqlite file remembering where each book's cover was found
+    'quality': 90, # jpeg quality for transcoded covers
+    'thumbnails': [], # (width, height) bounding boxes of extra, smaller covers
+    'thumbnail_quality': 85,
+    'gsCmd': 'gs', # used to render pdf covers when PyMuPDF is not installed
+    'pdf_resolution': 150, # dpi
+    'pdf_max_size': None, # (width, height) bound on rendered pdf covers
+    'max_member_size': 256 * 1024 * 1024, # bytes; larger members are never read into memory
+    'max_pixels': 25000000, # bigger jpegs are decoded at a reduced scale, bigger images of other formats refused
+    'max_memory': None, # bytes of address space per worker process
+    'dedup': None, # directory of converted covers shared by books whose cover images are identical
+    'output_dir': None, # sharded directory tree for covers, instead of writing them beside the books
+    'output_db': None, # sqlite file holding covers as blobs, instead of writing them beside the books
+    }
+
+class LazyModule:
+    '''A module imported the first time one of its attributes is used. lxml, Pillow, sqlite3 and the rest
+    cost more to import than this whole program, and a run may never need some of them'''
+    def __init__(self, name):
+        self.__name__ = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(vars(module)) # later lookups no longer come through here
+        return getattr(module, attr)
+
+def lazy_import(name):
+    '''A LazyModule for name, or None if it is not installed'''
+    try:
+        if importlib.util.find_spec(name) is None:
+            return None
+    except ImportError: # nor is its package
+        return None
+    return LazyModule(name)
+
+etree = lazy_import('lxml.etree')
+Image = lazy_import('PIL.Image')
+sqlite3 = lazy_import('sqlite3')
+ctypes = lazy_import('ctypes')
+futures = lazy_import('concurrent.futures')
+
+_parsers = threading.local() # lxml parsers must not be shared between threads
+
+def get_parser(kind):
+    '''This thread's parser for xml or html, built once. Both recover from the broken markup common
+    in epubs, accept deep trees and never fetch dtds or expand external entities'''
+    parser = getattr(_parsers, kind, None)
+    if parser is None:
+        if kind == 'html':
+            parser = etree.HTMLParser(recover=True, huge_tree=True, no_network=True)
+        else:
+            parser = etree.XMLParser(recover=True, huge_tree=True, no_network=True, resolve_entities=False)
+        setattr(_parsers, kind, parser)
+    return parser
+
+class LazyXPath:
+    '''An XPath compiled on first use, so that importing this module does not load lxml'''
+    def __init__(self, path):
+        self.path = path
+        self.xpath = None
 
-temp_dir = tempfile.mkdtemp()
+    def __call__(self, tree, **variables):
+        if self.xpath is None:
+            self.xpath = etree.XPath(self.path)
+        return self.xpath(tree, **variables)
+
+# the cover heuristics, compiled once. Namespaces vary between epubs, so names are matched by local-name();
+# the html parser keeps a prefixed attribute such as xlink:href under its full name
+ROOTFILE_PATH = LazyXPath('//*[local-name()="rootfile"]/@full-path')
+SRC_ATTRIBUTES = LazyXPath('//@*[local-name()="src" or name()="xlink:src"]')
+HREF_ATTRIBUTES = LazyXPath('//@*[local-name()="href" or name()="xlink:href"]')
+
+def all_images(values):
+    '''The attribute values that name images, in document order and without repeats'''
+    return list(dict.fromkeys(str(value) for value in values if os.path.splitext(value)[1].lower() in IMAGE_EXTENSIONS))
+
+# base scores of the ways a cover candidate is found; an image named by more than one scores higher still
+CANDIDATE_SCORES = {
+    'cover_from_properties': 100, # epub 3 manifest property
+    'cover_from_meta': 90,
+    'cover_from_guide': 80,
+    'cover_page_is_image': 70,
+    'image_from_src': 60,
+    'image_from_href': 60,
+    'cover_from_name': 20,
+    }
+
+PROBE_SIZE = 4096 # enough of an image for its header, unless a jpeg carries large exif or icc segments first
+MAX_PROBE_SIZE = 64 * 1024
+
+_modules = {}
+
+def optional_import(name):
+    '''Import an optional dependency the first time a book needs it, or None if it is not installed.
+    PyMuPDF alone takes longer to import than the rest of the program, so a run without pdfs never pays for it'''
+    if name not in _modules:
+        try:
+            _modules[name] = importlib.import_module(name)
+        except ImportError:
+            _modules[name] = None
+    return _modules[name]
+
+def configure(config):
+    '''Apply settings to this process'''
+    config_cfg.update(config)
+    close_store() # both reopened from the new settings on first use
+    close_index()
+
+def init_worker(config):
+    '''Initializer of worker processes: the settings, and the memory limit, which the parent is spared
+    so that its reader threads and the bookkeeping of the whole run cannot hit it'''
+    configure(config)
+    limit_memory(config_cfg['max_memory'])
+
+def limit_memory(max_memory):
+    '''Cap the address space of this process, so a pathological book raises MemoryError
+    in the worker handling it instead of drawing the OOM killer onto the whole batch'''
+    if not max_memory or resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        max_memory = min(max_memory, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory, hard))
 
 class Book:
     def __init__(self, book_file):
         self.book_file = book_file
         self.directory_name = None
+        self.cover_image = None
+        self.error = None
+        self.rejected = False # the failure lies in the book itself, so it recurs until the book changes
+        self.resolution = [] # the steps that led to the cover
+
+    def resolve(self, step):
+        '''Record a step taken to find the cover'''
+        self.resolution.append(step)
+        metrics.count(step)
+
+    def fail(self, msg):
+        '''Report why the cover could not be extracted, and return the failed counts'''
+        print(msg)
+        self.error = msg
+        return 0, 0, 1 # failed
+
+    def reject(self, msg):
+        '''fail, for a fault in the book rather than in the settings or the environment, which the index
+        may remember until the book changes'''
+        self.rejected = True
+        return self.fail(msg)
+
+    def too_large(self, entry):
+        '''Why an archive member or record is too large to read into memory, or None. zipfile never inflates
+        past the declared size, so the central directory can be trusted here'''
+        max_member_size = config_cfg['max_member_size']
+        if max_member_size and entry.file_size > max_member_size:
+            return f'{entry.filename} in {self.book_file} is {entry.file_size} bytes, over the {max_member_size} byte limit'
 
 class Epub(Book):
-    def __init__(self, book_file):
+    def __init__(self, book_file, book_data=None):
         super().__init__(book_file)
+        self.book_data = book_data
+        self.archive = None
+        self.entries = None
         self.opf = None
+        self.opf_path = None
+        self.opf_info = None
+        self.probes = {}
+        self.cover_page = None
         self.image = None
 
-    def extract_file(self, file_name, **kwargs):
-        '''Method for extracting a file to the temporary directory, or alternatively to another directory'''
-        directory = kwargs.get('directory', temp_dir)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_archive(self):
+        '''Open the epub archive on first use and keep the handle, so the central directory is only read once per book'''
+        if self.archive is None:
+            if isinstance(self.book_data, bytes): # the archive was already read into memory
+                self.archive = zipfile.ZipFile(io.BytesIO(self.book_data), 'r')
+            elif self.book_data is not None: # a binary file object
+                self.archive = zipfile.ZipFile(self.book_data, 'r')
+            else:
+                self.archive = zipfile.ZipFile(self.book_file, 'r')
+        return self.archive
+
+    def close(self):
+        '''Close the archive handle, if one was opened'''
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+            self.entries = None
+
+    def get_entry(self, file_name):
+        '''Look up a member by name in a map built once from the central directory.
+        Names are compared case-insensitively, URL-decoded and with ./ and ../ resolved,
+        since hrefs in the opf and cover page often differ from the stored names that way'''
+        if self.entries is None:
+            self.entries = {}
+            for info in self.get_archive().infolist():
+                self.entries.setdefault(normalize_member_name(info.filename), info)
+        entry = self.entries.get(normalize_member_name(file_name))
+        if entry is None and '#' in file_name: # an href to a fragment of the page
+            entry = self.entries.get(normalize_member_name(file_name.partition('#')[0]))
+        return entry
+
+    def read_file(self, file_name):
+        '''Return the contents of a file in the archive as bytes, or None if it cannot be read or is over the size limit'''
         try:
-            with zipfile.ZipFile(self.book_file, 'r') as epub_archive:
-                epub_archive.extract(file_name, directory) 
-        except zipfile.BadZipFile:
-            return 1, f'Bad zip file for {self.book_file}'
-        except KeyError:
-            return 1, f'No such file {file_name}'
-        else:
-            return 0, None
+            entry = self.get_entry(file_name)
+            if entry is None:
+                return None
+            if self.too_large(entry):
+                print(self.too_large(entry))
+                return None
+            return self.get_archive().read(entry)
+        except (zipfile.BadZipFile, OSError, zlib.error):
+            return None
 
     def get_all_contents(self):
         '''returns a list of all files in the epub archive'''
         try:
-            with zipfile.ZipFile(self.book_file, 'r') as epub_archive:
-                return epub_archive.read()
-        except:
-            return
+            return self.get_archive().namelist()
+        except zipfile.BadZipFile:
+            return []
 
     def get_info(self, afile):
         '''returns info about a given file in the archive'''
         try:
-            with zipfile.ZipFile(self.book_file, 'r') as epub_archive:
-                return epub_archive.getinfo(afile)
-        except KeyError:
+            return self.get_entry(afile)
+        except zipfile.BadZipFile:
             return
 
-    def parse_xml_file(self, file_name, dir_name=temp_dir):
-        '''parse opf file contents'''
+    def parse_xml_file(self, file_name):
+        '''parse an xml file (container.xml, the opf) straight from the archive'''
+        data = self.read_file(file_name)
+        if data is None:
+            return None
         try:
-            return etree.parse(os.path.join(dir_name, file_name))
-        except etree.ParseError:
+            return etree.fromstring(data, get_parser('xml'))
+        except etree.XMLSyntaxError:
             return None
 
     def get_opf_from_container(self, container_tree):
         '''Get the OPF file. First, try the most accurate, checking the container.xml file for its location.
         If not successful, guess the location as OEBPS/conetent.opf.
         If that file doesn't exist, get the first ocurrence on a list of all files in the archive'''
-        for el in container_tree.iter('{*}rootfile'): #get the opf file path
-            return el.attrib.get('full-path')
+        for path in ROOTFILE_PATH(container_tree): #get the opf file path
+            return str(path)
 
     def get_opf_from_default(self):
         '''Guess the most common location'''
@@ -77,247 +310,1987 @@ class Epub(Book):
         '''If nothing else works, unpack and find the first opf file'''
         contents = self.get_all_contents()
         for fname in contents:
-            if fname.endswith('.opf'):
+            if fname.lower().endswith('.opf'):
                 return fname
 
-    def get_cover_page_from_opf(self, opf_tree):
-        '''First find the reference with type=cover'''
-        '''<reference type="cover" title="Front Cover" href="page001.xhtml" />'''
-        cover_page = None
-        for e in opf_tree.iter('{*}reference'): ## 
-            cover_type = e.attrib.get('type')
-            if cover_type:
-                if cover_type.lower() == 'cover':
-                    cover_page = e.attrib['href']
-                if cover_page:
-                    return cover_page
-
-        '''Then try the first itemref id, get the corresponding item's href'''
-        el = opf_tree.find('.//{*}itemref')
-        cover_id = el.attrib.get('idref')
-        if cover_id:
-            items = opf_tree.findall('.//{*}item')
-            for item in items:
-                if item.attrib.get('id') == cover_id:
-                    return item.attrib.get('href')
-
-    #else:
     def check_if_cover_is_image(self, cover_page):
         '''sometimes the <reference href=> refers to an image, which what we want'''
         #print 'cover page: %s' % cover_page
         _, ext = os.path.splitext(cover_page)
-        if ext.lower() in ('.jpg', '.jpeg', '.png'): 
+        if ext.lower() in IMAGE_EXTENSIONS:
             return cover_page
 
-    def get_cover_tree(self, cover_page, cover_page_path=temp_dir):
+    def get_cover_tree(self, cover_page):
         '''parse the cover page, and return the element tree'''
-        cover_tree = None
         _, ext = os.path.splitext(cover_page)
         if ext.lower() in ('.html', '.xhtml', '.htm'):
-            parser = etree.HTMLParser()
+            cover_tree_text = self.read_file(cover_page)
+            if cover_tree_text is None:
+                return
             try:
-                with open(os.path.join(cover_page_path, cover_page)) as cover_tree_content:
-                    cover_tree_text = cover_tree_content.read().encode('utf-8')
-                    cover_tree = etree.parse(BytesIO(cover_tree_text), parser)
-            except ValueError as v:
+                return etree.fromstring(cover_tree_text, get_parser('html'))
+            except (ValueError, etree.XMLSyntaxError) as v:
                 print(v)
                 return
-            return cover_tree
-
         else:
             return self.parse_xml_file(cover_page)
-        return cover_tree
-
-    def get_image_from_src(self, cover_tree):
-        '''find the image in the cover page in the case of <img src=...>'''
-        for e in cover_tree.iter():
-            dtd = e.nsmap.get('xlink')
-            if dtd:
-                src = '{' + dtd + '}src'
-            else:
-                src = 'src'
-    
-            src_file = e.attrib.get(src)
-            if src_file and os.path.splitext(src_file)[1] in ('.jpg', '.jpeg', '.png'):
-                return src_file
-        return None
-        '''for e in cover_tree.iter('{*}img'):
-            #if e.attrib['alt'].lower() == 'cover':
-            image = e.attrib['src']
-            if image:
-                break
-        if not image:
-            for e in cover_tree.iter('{*}svg'):
-                #print e, e.attrib
-                image = e.attrib['src']'''
-
-    def get_image_from_href(self, cover_tree):
-        '''find the image in the cover page in the case of <img href=...>'''
-        for e in cover_tree.iter('*'):
-            dtd = e.nsmap.get('xlink')
-            if dtd:
-                href = '{' + dtd + '}href'
-            else:
-                href = 'href'
-            
-            href_file = e.attrib.get(href)
-            if href_file and os.path.splitext(href_file)[1] in ('.jpg', '.jpeg', '.png'):
-                return href_file
-    
 
     def correct_image_path(self, image, image_path):
         '''Add the path for image extraction'''
-        image = os.path.join(image_path, image) # make corrections to image path
-        image = re.sub('\/.+\/\.\.', '', image) # change OEBPS/../image/ to OEBPS/image, for example
-        return image
+        image = posixpath.join(image_path, image) # make corrections to image path
+        return posixpath.normpath(image) # change OEBPS/text/../image/ to OEBPS/image, for example
 
-    def get_image_location(self):
-        '''Find the image location by parsing the opf file'''
-        self.image = self.get_image_from_meta()
-        if not self.image:
-            self.image = self.get_image_from_cover_page()
-        if self.image:
-            self.image = re.sub('^\/', '', self.image) #remove leading '/'
-            return 0
+    def scan_opf(self):
+        '''Stream through the opf once, collecting every cover it declares: <meta name="cover">,
+        properties="cover-image" and a guide cover reference naming an image, along with the guide's cover page
+        and the first spine item for when it declares none. Elements are dropped as they are read, so memory
+        does not grow with the manifest. Returns None if the opf cannot be parsed'''
+        if self.opf_info is not None:
+            return self.opf_info
+        entry = self.get_entry(self.opf)
+        if entry is None:
+            return None
+        candidates = collections.defaultdict(set) # href -> the sources that name it
+        items = {} # manifest id -> (href, media type)
+        cover_ids = []
+        cover_page = first_idref = None
+        try:
+            with self.get_archive().open(entry) as opf_file:
+                elements = etree.iterparse(opf_file, tag=('{*}meta', '{*}item', '{*}itemref', '{*}reference'),
+                    recover=True, huge_tree=True, no_network=True, resolve_entities=False)
+                for _, el in elements:
+                    tag = el.tag.rpartition('}')[2]
+                    if tag == 'meta' and el.get('name', '').lower() == 'cover' and el.get('content'):
+                        cover_ids.append(el.get('content'))
+                    elif tag == 'item':
+                        href, media_type = el.get('href'), el.get('media-type', '')
+                        if href:
+                            items[el.get('id')] = href, media_type
+                            if 'cover-image' in el.get('properties', '').split(): # epub 3
+                                candidates[href].add('cover_from_properties')
+                    elif tag == 'itemref':
+                        if first_idref is None:
+                            first_idref = el.get('idref')
+                    elif tag == 'reference' and el.get('type', '').lower() == 'cover' and el.get('href'):
+                        if is_image(el.get('href')):
+                            candidates[el.get('href')].add('cover_from_guide')
+                        elif cover_page is None:
+                            cover_page = el.get('href')
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del el.getparent()[0]
+                if elements.root is None: # not xml at all
+                    return None
+        except (etree.XMLSyntaxError, zipfile.BadZipFile, OSError, zlib.error):
+            return None
+        for cover_id in cover_ids:
+            if cover_id in items and is_image(*items[cover_id]):
+                candidates[items[cover_id][0]].add('cover_from_meta')
+            elif cover_id not in items and is_image(cover_id): # content names the file rather than an item
+                candidates[cover_id].add('cover_from_meta')
+        first_page = items[first_idref][0] if first_idref in items else None
+        # hrefs are relative to the opf
+        self.opf_info = {
+            'candidates': merge_candidates((self.correct_image_path(href, self.opf_path), sources) for href, sources in candidates.items()),
+            'images': [self.correct_image_path(href, self.opf_path) for href, media_type in items.values() if is_image(href, media_type)],
+            'cover_page': cover_page and self.correct_image_path(cover_page, self.opf_path),
+            'first_page': first_page and self.correct_image_path(first_page, self.opf_path),
+            }
+        return self.opf_info
+
+    def get_candidates_from_cover_page(self):
+        '''Every image shown on the cover page: the guide's cover page, or else the first spine item.
+        Returns {path: sources}, or None with self.error set'''
+        info = self.scan_opf()
+        cover_page = info['cover_page'] or info['first_page']
+        if not cover_page:
+            self.error = f'cover page not found for {self.book_file}'
+            return None
+        self.cover_page = cover_page
+        if self.check_if_cover_is_image(cover_page):
+            return {cover_page: {'cover_page_is_image'}}
+        with metrics.time('cover_page_parse'):
+            cover_tree = self.get_cover_tree(cover_page)
+        if cover_tree is None:
+            self.error = f'Cannot parse cover page {cover_page}'
+            return None
+        found = []
+        page_path = posixpath.dirname(cover_page)
+        for source, attributes in (('image_from_src', SRC_ATTRIBUTES), ('image_from_href', HREF_ATTRIBUTES)):
+            with metrics.time(source):
+                found += [(self.correct_image_path(image, page_path), {source}) for image in all_images(attributes(cover_tree))]
+        candidates = merge_candidates(found)
+        if not candidates:
+            self.error = f'No image found in cover page {cover_page}'
+            return None
+        return candidates
+
+    def probe_image(self, file_name):
+        '''The true (extension, width, height) of an image member, from no more of it than its header.
+        None if the member is missing or is not an image we handle'''
+        if file_name not in self.probes:
+            entry = self.get_entry(file_name)
+            probe = None
+            if entry is not None:
+                try:
+                    with self.get_archive().open(entry) as member:
+                        head = member.read(PROBE_SIZE)
+                        probe = probe_image_header(head)
+                        if probe and probe[1] is None and len(head) == PROBE_SIZE: # the size is further in
+                            probe = probe_image_header(head + member.read(MAX_PROBE_SIZE - PROBE_SIZE))
+                except (OSError, zipfile.BadZipFile, zlib.error):
+                    probe = None
+            self.probes[file_name] = probe
+        return self.probes[file_name]
+
+    def score_candidate(self, file_name, sources):
+        '''How likely an image is to be the cover, from the sources naming it, its name and its dimensions'''
+        probe = self.probe_image(file_name)
+        if probe is None: # named like an image, but its bytes say otherwise
+            return -500
+        score = max(CANDIDATE_SCORES[source] for source in sources) + 10 * (len(sources) - 1)
+        name = posixpath.basename(file_name).lower()
+        if 'cover' in name:
+            score += 15
+        if 'thumb' in name or 'small' in name:
+            score -= 30
+        _, width, height = probe
+        if width and height:
+            if min(width, height) < 150: # an icon, logo or ornament
+                score -= 50
+            elif 1.2 <= height / width <= 1.9: # the usual cover proportions
+                score += 10
+            elif width > height:
+                score -= 10
+        return score
+
+    def present(self, candidates):
+        '''The candidates that are members of the archive, a declaration of a missing file being no cover at all'''
+        return {file_name: sources for file_name, sources in candidates.items() if self.get_entry(file_name) is not None}
+
+    def choose_cover(self, candidates):
+        '''The best scoring candidate, recording the strongest of the sources that named it.
+        Ties go to the one found first; a lone candidate is taken without probing it'''
+        if len(candidates) == 1:
+            cover_image, sources = next(iter(candidates.items()))
         else:
+            with metrics.time('cover_scoring'):
+                scores = {file_name: self.score_candidate(file_name, sources) for file_name, sources in candidates.items()}
+            cover_image = max(candidates, key=scores.get)
+            sources = candidates[cover_image]
+        self.resolve(max(sources, key=CANDIDATE_SCORES.get))
+        return cover_image
+
+    def get_image_location(self):
+        '''Find the image location: every cover the opf declares, or failing those the images on the cover page,
+        or failing that any manifest image named like a cover, scored against each other'''
+        info = self.scan_opf()
+        if info is None:
+            self.error = f'Cannot parse opf file {self.opf}'
+            return 1
+        candidates = self.present(info['candidates'])
+        if not candidates: # nothing declared, or only members the archive lacks
+            candidates = self.present(self.get_candidates_from_cover_page() or {})
+        if not candidates:
+            candidates = self.present({image: {'cover_from_name'} for image in info['images'] if 'cover' in posixpath.basename(image).lower()})
+        if not candidates:
             return 1
+        self.image = re.sub('^/', '', self.choose_cover(candidates)) #remove leading '/'
+        return 0
+
+    def stream_file(self, file_name, destination):
+        '''Copy a member to destination in chunks, without holding it in memory.
+        Stored members of an archive on disk are copied as a raw byte range'''
+        archive = self.get_archive()
+        info = self.get_entry(file_name)
+        if info is None:
+            raise KeyError(f'No such file {file_name}')
+        with open_atomic(destination) as output:
+            if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1 and self.book_data is None:
+                with open(self.book_file, 'rb') as book:
+                    book.seek(info.header_offset)
+                    header = book.read(30) # local file header; its name and extra field lengths may differ from the central directory
+                    if header[:4] != b'PK\x03\x04':
+                        raise zipfile.BadZipFile(f'Bad local header for {file_name}')
+                    name_length, extra_length = struct.unpack('<HH', header[26:30])
+                    book.seek(info.header_offset + 30 + name_length + extra_length)
+                    copy_range(book, output, info.compress_size)
+            else:
+                with archive.open(info) as member:
+                    shutil.copyfileobj(member, output, CHUNK_SIZE)
+
+    def warm(self, file_name):
+        '''Read a member's stored bytes through without keeping them, so that the process extracting it
+        finds them in the page cache rather than waiting on slow storage'''
+        info = self.get_entry(file_name)
+        if info is None or self.book_data is not None or self.too_large(info):
+            return
+        with open(self.book_file, 'rb') as book:
+            book.seek(info.header_offset)
+            header = book.read(30)
+            if header[:4] != b'PK\x03\x04':
+                return
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            size = name_length + extra_length + info.compress_size
+            while size > 0:
+                chunk = book.read(min(size, CHUNK_SIZE))
+                if not chunk:
+                    break
+                size -= len(chunk)
+
+    def hash_file(self, file_name):
+        '''sha256 of a member's contents, read in chunks'''
+        digest = hashlib.sha256()
+        with self.get_archive().open(self.get_entry(file_name)) as member:
+            for chunk in iter(lambda: member.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
 
     def extract_image(self):
         '''Extract image from epub'''
-        status, msg = self.extract_file(self.cover_image)
-        #if status != 0:
-        #    status, msg = self.extract_file(os.path.join('OEBPS', self.cover_image))
-        print(status)
-        print(msg)
-        _, imageext = os.path.splitext(self.cover_image)
-        if imageext.lower() == '.jpeg' or '.jpg':
-            try:
-                shutil.copy(os.path.join(temp_dir, self.cover_image), os.path.splitext(self.book_file)[0] + '.jpg')
-            except IOError as e:
-                print('{}: {}'.format(os.path.splitext(self.book_file)[0], e))
-                return 1
+        entry = self.get_info(self.cover_image)
+        if entry is None:
+            self.reject(f'No such file {self.cover_image} in {self.book_file}')
+            return 1
+        base_name = get_store().base_name(self.book_file)
+        probe = self.probe_image(self.cover_image)
+        if probe is None:
+            self.reject(f'{self.cover_image} in {self.book_file} is not an image')
+            return 1
+        image_format, width, height = probe
+        # a jpeg is decoded at up to 1/8 scale, so only one too large even for that is refused unread
+        max_pixels = config_cfg['max_pixels'] * (64 if image_format == '.jpg' else 1)
+        if image_format == '.jpg' and not config_cfg['thumbnails'] and not config_cfg['dedup']:
+            try: # nothing to decode, so stream it straight to the destination
+                with metrics.time('image_write'):
+                    self.stream_file(self.cover_image, base_name + '.jpg')
+                status = 0
+            except (OSError, zipfile.BadZipFile, zlib.error) as e:
+                print('{}: {}'.format(base_name, e))
+                status = 1
+        elif self.too_large(entry):
+            self.fail(self.too_large(entry))
+            return 1
+        elif max_pixels and width and height and width * height > max_pixels:
+            self.fail(f'{width}x{height} image is over the {config_cfg["max_pixels"]} pixel limit in {self.book_file}')
+            return 1
+        elif config_cfg['dedup']:
+            with metrics.time('image_convert'):
+                status = dedup_cover(self, entry, base_name)
+        else:
+            with metrics.time('image_convert'):
+                image_data = self.read_file(self.cover_image)
+                status = 1 if image_data is None else write_cover(image_data, self.cover_image, base_name)
+        if status == 0:
             print('Successfully extracted image from %s' % self.book_file)
-            return 0
         else:
-            returncode = subprocess.call(['convert', os.file.join(temp_dir, self.cover_image), os.path.splitext(self.book_file)[0] + '.jpg']) # if not jpeg, use imagemagick to convert
-            if returncode == 0:
-                print('Extraction completed for %s' % self.book_file)
+            self.fail('Error converting image %s for epub %s' % (self.cover_image, self.book_file))
+        return status
+
+def is_image(href, media_type=''):
+    '''Whether a manifest href, or its declared media type, is one of the image formats we handle'''
+    return media_type.startswith('image/') or os.path.splitext(href)[1].lower() in IMAGE_EXTENSIONS
+
+# start of frame markers, the ones carrying the image size; c4, c8 and cc share the range but are not frames
+JPEG_FRAMES = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+SVG_ROOT = re.compile(rb'<svg\b[^>]*>', re.IGNORECASE)
+SVG_LENGTH = re.compile(r'\s*([0-9.]+)\s*(px)?\s*$')
+
+def svg_attribute(root, name):
+    match = re.search(rb'\s' + name + rb'\s*=\s*["\']([^"\']*)["\']', root)
+    return match.group(1).decode('ascii', 'replace') if match else None
+
+def probe_image_header(head):
+    '''The true format and size of an image from its first bytes, as (extension, width, height), without
+    decoding it. The size is None when the header is cut short or does not give one, as for an svg sized
+    in relative units. None if the bytes are not a jpeg, png, gif, webp or svg'''
+    if head.startswith(b'\xff\xd8'):
+        i = 2
+        while i + 9 <= len(head) and head[i] == 0xff:
+            marker = head[i + 1]
+            if marker == 0xff: # fill byte
+                i += 1
+            elif marker == 0x01 or 0xd0 <= marker <= 0xd8: # no length
+                i += 2
+            elif marker in JPEG_FRAMES:
+                height, width = struct.unpack('>HH', head[i + 5:i + 9])
+                return '.jpg', width, height
+            elif marker == 0xda: # image data follows, with no frame before it
+                break
+            else:
+                i += 2 + struct.unpack('>H', head[i + 2:i + 4])[0]
+        return '.jpg', None, None
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        if len(head) >= 24 and head[12:16] == b'IHDR':
+            return ('.png', *struct.unpack('>LL', head[16:24]))
+        return '.png', None, None
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        if len(head) >= 10:
+            return ('.gif', *struct.unpack('<HH', head[6:10]))
+        return '.gif', None, None
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        chunk = head[12:16]
+        if chunk == b'VP8 ' and len(head) >= 30:
+            width, height = struct.unpack('<HH', head[26:30])
+            return '.webp', width & 0x3fff, height & 0x3fff
+        if chunk == b'VP8L' and len(head) >= 25:
+            bits, = struct.unpack('<L', head[21:25])
+            return '.webp', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b'VP8X' and len(head) >= 30:
+            return '.webp', int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+        return '.webp', None, None
+    root = SVG_ROOT.search(head)
+    if root and head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<'):
+        width, height = (SVG_LENGTH.match(svg_attribute(root.group(), name) or '') for name in (b'width', b'height'))
+        view_box = (svg_attribute(root.group(), b'viewBox') or '').replace(',', ' ').split()
+        try:
+            if width and height:
+                return '.svg', round(float(width.group(1))), round(float(height.group(1)))
+            return '.svg', round(float(view_box[2])), round(float(view_box[3]))
+        except (IndexError, ValueError):
+            return '.svg', None, None
+    return None
+
+def normalize_member_name(name):
+    '''Key for comparing archive member names: URL-decoded, forward slashes, no ./ or ../, lower case'''
+    name = urllib.parse.unquote(name).replace('\\', '/')
+    return posixpath.normpath(name).lstrip('/').lower()
+
+def merge_candidates(candidates):
+    '''Combine (path, sources) pairs naming the same member however it is spelt, keeping the first
+    spelling, so that every source naming a cover counts towards its score'''
+    merged, paths = {}, {}
+    for path, sources in candidates:
+        path = paths.setdefault(normalize_member_name(path), path)
+        merged.setdefault(path, set()).update(sources)
+    return merged
+
+def copy_range(source, destination, size):
+    '''Copy size bytes from the current position of source, in chunks'''
+    while size > 0:
+        chunk = source.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated archive member')
+        destination.write(chunk)
+        size -= len(chunk)
+
+def part_name(file_name):
+    '''A unique temporary name next to file_name'''
+    return os.path.join(os.path.dirname(file_name), '.%s.%s.part' % (os.path.basename(file_name), os.urandom(4).hex()))
+
+@contextlib.contextmanager
+def open_atomic(file_name):
+    '''Write to a temporary file in the same directory, renamed over file_name only once complete,
+    so an interrupted run never leaves a truncated cover that the next run would skip'''
+    temp_name = part_name(file_name)
+    fd = os.open(temp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            yield output
+        os.replace(temp_name, file_name)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(temp_name)
+        raise
+
+def link_cover(stored, file_name):
+    '''Put a stored cover in place as a hard link, or where the store is on another file system
+    as a reflink or, failing that, a copy'''
+    temp_name = part_name(file_name)
+    try:
+        os.link(stored, temp_name)
+        os.replace(temp_name, file_name)
+        return
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(temp_name)
+    with open(stored, 'rb') as source, open_atomic(file_name) as output:
+        try:
+            fcntl.ioctl(output.fileno(), FICLONE, source.fileno())
+        except (AttributeError, OSError): # no fcntl, or no reflinks on this file system
+            shutil.copyfileobj(source, output, CHUNK_SIZE)
+
+def dedup_cover(ebook, entry, base_name):
+    '''Write the cover of ebook through the dedup store: each distinct image is converted once, under
+    its sha256, and linked into place for every book that shares it. Store entries are grouped by the
+    member's CRC32 and size from the zip directory, so the member is only hashed ahead of its conversion
+    when a cover of the same CRC32 and size is already stored. Returns 0 on success like write_cover'''
+    probe = ebook.probe_image(ebook.cover_image)
+    is_jpeg = probe[0] == '.jpg' if probe else os.path.splitext(ebook.cover_image)[1].lower() in ('.jpg', '.jpeg')
+    prefilter_dir = os.path.join(config_cfg['dedup'], '%08x-%d' % (entry.CRC, entry.file_size))
+    settings = '' if is_jpeg and not config_cfg['thumbnails'] else '-q%d-%d' % (config_cfg['quality'], config_cfg['thumbnail_quality'])
+    outputs = output_suffixes()
+    try:
+        if os.path.isdir(prefilter_dir):
+            stored = os.path.join(prefilter_dir, ebook.hash_file(ebook.cover_image) + settings)
+            if all(os.path.isfile(stored + output) for output in outputs):
+                for output in outputs:
+                    link_cover(stored + output, base_name + output)
+                metrics.count('dedup_hit')
                 return 0
+        os.makedirs(prefilter_dir, exist_ok=True)
+        if is_jpeg and not config_cfg['thumbnails']: # nothing to convert, so only the disk space is shared
+            stored = os.path.join(prefilter_dir, ebook.hash_file(ebook.cover_image))
+            ebook.stream_file(ebook.cover_image, stored + '.jpg')
+        else:
+            image_data = ebook.read_file(ebook.cover_image)
+            if image_data is None:
+                return 1
+            stored = os.path.join(prefilter_dir, hashlib.sha256(image_data).hexdigest() + settings)
+            if write_cover(image_data, ebook.cover_image, stored) != 0:
+                return 1
+        for output in outputs:
+            link_cover(stored + output, base_name + output)
+    except (OSError, zipfile.BadZipFile, zlib.error) as e:
+        print('{}: {}'.format(base_name, e))
+        return 1
+    metrics.count('dedup_miss')
+    return 0
+
+def open_image(image_data, image_name, size=None):
+    '''Decode cover bytes with Pillow, rasterising svg covers first. A jpeg may be decoded at a reduced scale,
+    no smaller than size, and is when it is over the pixel limit; other formats over the limit are refused'''
+    if os.path.splitext(image_name)[1].lower() == '.svg':
+        cairosvg = optional_import('cairosvg')
+        if cairosvg is None:
+            raise ValueError('cairosvg is needed to rasterise svg covers')
+        image_data = cairosvg.svg2png(bytestring=image_data)
+    image = Image.open(io.BytesIO(image_data))
+    max_pixels = config_cfg['max_pixels']
+    drafts = [size] if size else []
+    if max_pixels and image.width * image.height > max_pixels:
+        # the decoder picks the largest 1/2, 1/4 or 1/8 scale no smaller than the draft size, so asking for
+        # half the size that fits the limit always lands within it
+        scale = math.sqrt(max_pixels / (image.width * image.height)) / 2
+        drafts.append((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+    if drafts and image.format == 'JPEG':
+        image.draft('RGB', min(drafts, key=lambda draft: draft[0] * draft[1]))
+    if max_pixels and image.width * image.height > max_pixels:
+        raise ValueError(f'{image.width}x{image.height} image is over the {max_pixels} pixel limit')
+    return image
+
+def to_jpeg_mode(image):
+    '''Flatten any transparency onto white, since jpeg has no alpha channel'''
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    if image.mode not in ('RGB', 'L', 'CMYK'):
+        return image.convert('RGB')
+    return image
+
+def thumbnail_name(base_name, size):
+    return '%s-%dx%d.jpg' % (base_name, *size)
+
+def output_suffixes():
+    '''What is appended to a base name for each file written per book: the cover, then the thumbnails'''
+    return ['.jpg'] + [thumbnail_name('', size) for size in config_cfg['thumbnails']]
+
+def write_cover(image_data, image_name, base_name):
+    '''Write the cover to base_name.jpg plus any configured thumbnails. Jpeg covers are written as is,
+    anything else is transcoded in process with Pillow, or with ImageMagick if Pillow is missing.
+    The format is taken from the image header, and from image_name only when the header is not recognised'''
+    image_format, width, height = probe_image_header(image_data[:MAX_PROBE_SIZE]) or (os.path.splitext(image_name)[1].lower(), None, None)
+    is_jpeg = image_format in ('.jpg', '.jpeg')
+    image_name = os.path.splitext(image_name)[0] + image_format
+    thumbnails = config_cfg['thumbnails']
+    if is_jpeg and width and all(width <= box_width and height <= box_height for box_width, box_height in thumbnails):
+        thumbnails = [] # already no larger than every thumbnail, so those are copies of the cover
+        for size in config_cfg['thumbnails']:
+            try:
+                with open_atomic(thumbnail_name(base_name, size)) as image_file:
+                    image_file.write(image_data)
+            except OSError as e:
+                print('{}: {}'.format(base_name, e))
+                return 1
+    if Image is None:
+        return write_cover_imagemagick(image_data, is_jpeg, base_name, thumbnails)
+    try:
+        if is_jpeg:
+            with open_atomic(base_name + '.jpg') as image_file:
+                image_file.write(image_data)
+        if not is_jpeg or thumbnails:
+            # when only thumbnails are needed the decoder can scale down
+            image = open_image(image_data, image_name, max(thumbnails) if is_jpeg else None)
+            image = to_jpeg_mode(image)
+            if not is_jpeg:
+                with open_atomic(base_name + '.jpg') as image_file:
+                    image.save(image_file, 'JPEG', quality=config_cfg['quality'])
+            for size in thumbnails:
+                thumbnail = image.copy()
+                thumbnail.thumbnail(size, Image.LANCZOS)
+                with open_atomic(thumbnail_name(base_name, size)) as image_file:
+                    thumbnail.save(image_file, 'JPEG', quality=config_cfg['thumbnail_quality'])
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print('{}: {}'.format(base_name, e))
+        return 1
+    return 0
+
+def write_cover_imagemagick(image_data, is_jpeg, base_name, thumbnails):
+    '''Fallback for write_cover, feeding the image to ImageMagick on stdin'''
+    commands = []
+    if is_jpeg:
+        try:
+            with open_atomic(base_name + '.jpg') as image_file:
+                image_file.write(image_data)
+        except IOError as e:
+            print('{}: {}'.format(base_name, e))
+            return 1
+    else:
+        commands.append(['-quality', str(config_cfg['quality']), base_name + '.jpg'])
+    for size in thumbnails:
+        commands.append(['-thumbnail', '%dx%d' % size, '-quality', str(config_cfg['thumbnail_quality']), thumbnail_name(base_name, size)])
+    limits = [] # past these ImageMagick keeps its pixel cache on disk rather than in memory
+    if config_cfg['max_pixels']:
+        limits += ['-limit', 'area', str(config_cfg['max_pixels'])]
+    if config_cfg['max_memory']:
+        limits += ['-limit', 'memory', str(config_cfg['max_memory']), '-limit', 'map', str(config_cfg['max_memory'])]
+    commands = [['convert'] + limits + ['-'] + command for command in commands]
+    for command in commands:
+        try:
+            returncode = subprocess.run(command, input=image_data).returncode
+        except OSError:
+            returncode = 1
+        if returncode != 0:
+            print('Error running %s. Do you have ImageMagick installed?' % command[0])
+            return 1
+    return 0
+
+class CoverIndex:
+    '''Persistent index of resolved cover locations and outcomes, keyed by book path and fingerprint'''
+    def __init__(self, index_file):
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(index_file, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS covers (
+            path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, cd_hash TEXT,
+            opf TEXT, cover_page TEXT, cover_image TEXT, outcome TEXT)''')
+        self.connection.commit()
+
+    def lookup(self, book_file, fingerprint):
+        '''Return the stored entry for a book, or None if it is unknown or has changed since'''
+        row = self.connection.execute('''SELECT size, mtime, cd_hash, opf, cover_page, cover_image, outcome
+            FROM covers WHERE path = ?''', (os.path.abspath(book_file),)).fetchone()
+        if row is None or tuple(row[:3]) != tuple(fingerprint):
+            return None
+        return dict(zip(('opf', 'cover_page', 'cover_image', 'outcome'), row[3:]))
+
+    def store(self, book_file, fingerprint, opf, cover_page, cover_image, outcome):
+        '''Record where the cover of a book was found and whether extraction succeeded: outcome is created,
+        failed for a book that cannot succeed until it changes, or None after a failure that may not recur'''
+        with self.connection:
+            self.connection.execute('''INSERT OR REPLACE INTO covers VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                (os.path.abspath(book_file), *fingerprint, opf, cover_page, cover_image, outcome))
+
+    def close(self):
+        self.connection.close()
+
+_index = None
+
+def get_index():
+    '''Open the configured cover index once per process'''
+    global _index
+    if (_index is None or inherited(_index)) and config_cfg['index']:
+        _index = CoverIndex(config_cfg['index'])
+    return _index
+
+def close_index():
+    '''Close the cover index of this process, like close_store'''
+    global _index
+    if _index is not None and not inherited(_index):
+        _index.close()
+    _index = None
+
+def get_fingerprint(file_name):
+    '''Return (size, mtime, hash) for a book. The hash covers the zip central directory,
+    or the last 64k of the file if there is none (PDFs, zip64 archives)'''
+    try:
+        st = os.stat(file_name)
+        with open(file_name, 'rb') as book:
+            tail_size = min(st.st_size, 65536 + 22) # the end of central directory record, plus a maximal comment
+            book.seek(st.st_size - tail_size)
+            tail = book.read(tail_size)
+            data = tail
+            eocd = tail.rfind(b'PK\x05\x06')
+            if eocd >= 0 and len(tail) - eocd >= 22:
+                cd_size, cd_offset = struct.unpack('<LL', tail[eocd + 12:eocd + 20])
+                if cd_offset != 0xffffffff and cd_offset + cd_size <= st.st_size:
+                    book.seek(cd_offset)
+                    data = book.read(cd_size)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns, hashlib.sha1(data).hexdigest()
+
+class SiblingStore:
+    '''Covers written beside their books, book.epub getting book.jpg; the default'''
+    def base_name(self, book_file):
+        '''Where the cover of a book is written, less the .jpg'''
+        return os.path.splitext(book_file)[0]
+
+    def exists(self, book_file):
+        return os.path.isfile(self.base_name(book_file) + '.jpg')
+
+    def add(self, book_file):
+        '''Record that the cover of a book has been written'''
+
+    def discard(self, book_file):
+        '''Forget the cover of a book, so that it is extracted again'''
+        for suffix in output_suffixes():
+            try:
+                os.unlink(self.base_name(book_file) + suffix)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        pass
+
+class ShardedStore(SiblingStore):
+    '''Covers kept in a directory tree of their own, named by a hash of the book path and spread over
+    subdirectories by its first two bytes, so the library is only ever read and no directory grows large.
+    Skip checks are answered by an sqlite index in the tree rather than by a stat per book'''
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shards = set() # subdirectories known to exist
+        self.lock = threading.Lock() # the async pipeline checks for covers from its reader threads
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(self.index_file(), timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(self.SCHEMA)
+        self.connection.commit()
+
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS covers (book TEXT PRIMARY KEY, key TEXT)'''
+
+    def index_file(self):
+        return os.path.join(self.directory, 'index.sqlite')
+
+    def key(self, book_file):
+        return hashlib.sha1(os.fsencode(os.path.abspath(book_file))).hexdigest()
+
+    def base_name(self, book_file):
+        key = self.key(book_file)
+        shard = os.path.join(self.directory, key[:2], key[2:4])
+        if shard not in self.shards:
+            os.makedirs(shard, exist_ok=True)
+            self.shards.add(shard)
+        return os.path.join(shard, key)
+
+    def exists(self, book_file):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM covers WHERE book = ?', (os.path.abspath(book_file),)).fetchone() is not None
+
+    def add(self, book_file):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO covers VALUES (?, ?)', (os.path.abspath(book_file), self.key(book_file)))
+
+    def discard(self, book_file):
+        '''Forget the cover of a book; its files are overwritten when it is extracted again'''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM covers WHERE book = ?', (os.path.abspath(book_file),))
+
+    def close(self):
+        self.connection.close()
+
+class BlobStore(ShardedStore):
+    '''Covers packed into one sqlite file, a row per cover or thumbnail, for bulk writes and libraries on
+    mounts where creating files is slow. Covers are written to a local spool directory as usual, then moved in'''
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS covers (book TEXT, suffix TEXT, data BLOB, PRIMARY KEY (book, suffix))'''
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # one per process, since close removes it while other workers and runs may still be writing theirs
+        spool = 'covers-%s-%d' % (hashlib.sha1(os.fsencode(os.path.abspath(db_file))).hexdigest()[:12], os.getpid())
+        super().__init__(os.path.join(tempfile.gettempdir(), spool))
+        # worker processes never call close_store, but do run these finalizers as they exit
+        import multiprocessing.util # only this store needs it, and it is slow to import
+        multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+
+    def index_file(self):
+        return self.db_file
+
+    def base_name(self, book_file):
+        return os.path.join(self.directory, self.key(book_file))
+
+    def exists(self, book_file):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM covers WHERE book = ? AND suffix = ?', (os.path.abspath(book_file), '.jpg')).fetchone() is not None
+
+    def add(self, book_file):
+        base_name = self.base_name(book_file)
+        rows = []
+        for suffix in output_suffixes():
+            with open(base_name + suffix, 'rb') as image_file:
+                rows.append((os.path.abspath(book_file), suffix, image_file.read()))
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO covers VALUES (?, ?, ?)', rows)
+        for suffix in output_suffixes():
+            os.unlink(base_name + suffix)
+
+    def get(self, book_file, suffix='.jpg'):
+        '''The stored cover of a book, or one of its thumbnails ('-WxH.jpg'), as bytes; None if there is none'''
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM covers WHERE book = ? AND suffix = ?', (os.path.abspath(book_file), suffix)).fetchone()
+        return row and row[0]
+
+    def close(self):
+        super().close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+_store = None
+_store_lock = threading.Lock() # the async pipeline's reader threads open the store too
+
+def reset_store_lock():
+    '''A forked worker must not inherit the lock held by a thread that does not exist in it'''
+    global _store_lock
+    _store_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_store_lock)
+
+def inherited(store):
+    '''Whether a store, or the index, was opened by the process this one was forked from'''
+    return getattr(store, 'pid', os.getpid()) != os.getpid()
+
+def get_store():
+    '''Open the configured output store once per process; worker processes open their own'''
+    global _store
+    with _store_lock:
+        if _store is None or inherited(_store):
+            if config_cfg['output_db']:
+                _store = BlobStore(config_cfg['output_db'])
+            elif config_cfg['output_dir']:
+                _store = ShardedStore(config_cfg['output_dir'])
             else:
-                print('Error converting image %s for epub %s. Do you have ImageMagick installed?' % (self.cover_image, self.book_file))
-                return 1 
+                _store = SiblingStore()
+        return _store
 
-class Pdf(Book):
-    def __init__(self, book_file):
+def close_store():
+    '''Close the output store of this process, so the next get_store opens the configured one.
+    A store inherited from the parent is only dropped: its connection and spool are the parent's'''
+    global _store
+    with _store_lock:
+        if _store is not None and not inherited(_store):
+            _store.close()
+        _store = None
+
+class Metrics:
+    '''Timing histograms per stage and event counters for a run, dumped as json or Prometheus text'''
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock() # the async pipeline's reader threads time their reads too
+        self.stages = {} # stage -> [count per bucket..., count above the last bucket, total seconds]
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        '''Time the body of a with statement as one observation of stage'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.setdefault(stage, [0] * (len(self.BUCKETS) + 2))
+            histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def count(self, event, n=1):
+        with self.lock:
+            self.counters[event] += n
+
+    def snapshot(self):
+        '''Plain data, small enough to send back from a worker process'''
+        with self.lock:
+            return {'stages': {stage: list(histogram) for stage, histogram in self.stages.items()}, 'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        with self.lock:
+            for stage, histogram in snapshot['stages'].items():
+                total = self.stages.setdefault(stage, [0] * (len(self.BUCKETS) + 2))
+                for i, value in enumerate(histogram):
+                    total[i] += value
+            self.counters.update(snapshot['counters'])
+
+    def to_json(self):
+        stages = {}
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = list(itertools.accumulate(histogram[:-1]))
+            stages[stage] = {
+                'count': cumulative[-1],
+                'sum': round(histogram[-1], 6),
+                'buckets': {str(le): n for le, n in zip(self.BUCKETS, cumulative)},
+                }
+        return json.dumps({'stages': stages, 'counters': dict(sorted(self.counters.items()))}, indent=2)
+
+    def to_prometheus(self):
+        lines = ['# TYPE ebook_stage_seconds histogram']
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = list(itertools.accumulate(histogram[:-1]))
+            for le, n in zip(self.BUCKETS + ('+Inf',), cumulative):
+                lines.append(f'ebook_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'ebook_stage_seconds_sum{{stage="{stage}"}} {histogram[-1]:.6f}')
+            lines.append(f'ebook_stage_seconds_count{{stage="{stage}"}} {cumulative[-1]}')
+        lines.append('# TYPE ebook_events_total counter')
+        for event, n in sorted(self.counters.items()):
+            lines.append(f'ebook_events_total{{event="{event}"}} {n}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, file_name, fmt='json'):
+        '''Write the metrics out, replacing any previous dump'''
+        with self.lock:
+            text = self.to_prometheus() if fmt == 'prometheus' else self.to_json()
+        with open_atomic(file_name) as output:
+            output.write(text.encode('utf-8'))
+
+metrics = Metrics()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics.reset) # a worker reports its own books, and not under a lock it cannot release
+
+class CoverBook(Book):
+    '''A book whose cover comes out of read_cover in one step, as image bytes to write with write_cover'''
+    stage = 'cover_read'
+
+    def __init__(self, book_file, book_data=None):
         super().__init__(book_file)
+        self.book_data = book_data
+
+    def open_book(self):
+        '''A binary file of the book, whether it is on disk or was passed in as bytes or a file object'''
+        if isinstance(self.book_data, bytes):
+            return io.BytesIO(self.book_data)
+        elif self.book_data is not None:
+            return contextlib.nullcontext(self.book_data)
+        return open(self.book_file, 'rb')
+
+    def read_cover(self):
+        '''Return (0, image bytes) and set cover_image, or (1, the reason there is no cover)'''
+        raise NotImplementedError
+
+    def extract_file(self):
+        '''Read the cover and write it, with any thumbnails'''
+        with metrics.time(self.stage):
+            status, image_data = self.read_cover()
+        if status != 0:
+            return status, image_data
+        with metrics.time('image_write'):
+            status = write_cover(image_data, self.cover_image or 'cover.jpg', get_store().base_name(self.book_file))
+        if status != 0:
+            return 1, f'Cannot write cover for {self.book_file}'
+        return 0, None
+
+class Pdf(CoverBook):
+    stage = 'pdf_render'
+
+    def read_cover(self):
+        '''The first page, rendered'''
+        status, image_data = self.render_cover()
+        if status == 0:
+            self.resolve('pdf_render')
+        return status, image_data
+
+    def render_cover(self):
+        '''Render the first page as jpeg bytes, in process with PyMuPDF when it is available'''
+        if optional_import('pymupdf') is not None:
+            return self.render_with_pymupdf()
+        return self.render_with_ghostscript()
+
+    def render_with_pymupdf(self):
+        '''Render at the configured resolution, scaled down to fit the maximum size'''
+        pymupdf = optional_import('pymupdf')
+        try:
+            if self.book_data is not None:
+                document = pymupdf.open(stream=self.book_data, filetype='pdf')
+            else:
+                document = pymupdf.open(self.book_file)
+            with document:
+                page = document[0]
+                zoom = config_cfg['pdf_resolution'] / 72
+                if config_cfg['pdf_max_size']:
+                    max_width, max_height = config_cfg['pdf_max_size']
+                    zoom = min(zoom, max_width / page.rect.width, max_height / page.rect.height)
+                if config_cfg['max_pixels']:
+                    zoom = min(zoom, math.sqrt(config_cfg['max_pixels'] / (page.rect.width * page.rect.height)))
+                pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+                return 0, pixmap.tobytes('jpeg', jpg_quality=config_cfg['quality'])
+        except (RuntimeError, ValueError, IndexError, OSError) as e:
+            return 1, f'Cannot render {self.book_file}: {e}'
+
+    def render_with_ghostscript(self):
+        '''Render with a Ghostscript process, reading the jpeg from its stdout'''
+        gsargs = ghostscript_args() + ['-dFirstPage=1', '-dLastPage=1',
+            '-sOutputFile=-', '-' if self.book_data is not None else self.book_file]
+        try:
+            completed = subprocess.run(gsargs, input=self.book_data, capture_output=True)
+        except OSError as e:
+            return 1, f'Cannot run {gsargs[0]}: {e}'
+        if completed.returncode != 0 or not completed.stdout:
+            return 1, f'Ghostscript failed for {self.book_file}: {completed.stderr.decode(errors="replace").strip()}'
+        try:
+            return 0, self.fit_to_max_size(completed.stdout)
+        except (OSError, ValueError) as e:
+            return 1, f'Cannot read the render of {self.book_file}: {e}'
+
+    def fit_to_max_size(self, image_data):
+        '''Ghostscript cannot bound the bitmap without knowing the page size, so shrink its output afterwards'''
+        if not config_cfg['pdf_max_size'] or Image is None:
+            return image_data
+        image = open_image(image_data, 'cover.jpg', config_cfg['pdf_max_size'])
+        max_width, max_height = config_cfg['pdf_max_size']
+        if image.width <= max_width and image.height <= max_height:
+            return image_data
+        image.thumbnail(config_cfg['pdf_max_size'], Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=config_cfg['quality'])
+        return output.getvalue()
+
+def ghostscript_args():
+    '''The Ghostscript command line, up to the output and input'''
+    return shlex.split(config_cfg['gsCmd']) + ['-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dNOPROMPT',
+        '-dAlignToPixels=0', '-dUseCropBox', '-dGridFitTT=2', '-sDEVICE=jpeg', '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4',
+        '-r%d' % config_cfg['pdf_resolution'], '-dJPEGQ=%d' % config_cfg['quality']]
 
-    def extract_file(self): # to do: add settings configuration to increase/decrease file size, resolution
-        bookname, _ = os.path.splitext(self.book_file)
-        gscommand = '%s -dSAFER -dBATCH -dNOPAUSE -dNOPROMPT -dMaxBitmap=500000000 -dAlignToPixels=0 -dUseCropBox -dGridFitTT=2 -sDEVICE=jpeg -dTextAlphaBits=4 -dGraphicsAlphaBits=4 -dUseCIEColor -r250x250 -dFirstPage=1 -dLastPage=1' % config_cfg['gsCmd']#    -sOUTPUTFILE=' #%s %s' % (book, bookname + 'jpg')
-        gsargs = shlex.split(gscommand)
-        gsargs.append('-sOUTPUTFILE=' + bookname + '.jpg')
-        gsargs.append(self.book_file)
-        return subprocess.call(gsargs)
-
-def get_epub_list():
-    '''Get the epub/pdf full path file names from directory given as an argument'''
-    usage = '''Ebook image extractor. 
-    USAGE: python ebook_image_extractor.py epub_directory/
+def natural_key(name):
+    '''Sort key putting page2 before page10'''
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name.lower())]
+
+def image_name(image_data, stem='cover'):
+    '''A file name for image bytes with no name of their own, its extension telling write_cover the format'''
+    probe = probe_image_header(image_data[:MAX_PROBE_SIZE])
+    return stem + (probe[0] if probe else '.jpg')
+
+class Cbz(CoverBook):
+    '''Comic book archives: the cover is the page named cover, or else the first page in reading order'''
+    def open_archive(self):
+        if isinstance(self.book_data, bytes):
+            return zipfile.ZipFile(io.BytesIO(self.book_data))
+        return zipfile.ZipFile(self.book_data if self.book_data is not None else self.book_file)
+
+    def archive_errors(self):
+        return zipfile.BadZipFile, OSError, zlib.error
+
+    def read_cover(self):
+        try:
+            with self.open_archive() as archive:
+                pages = [info for info in archive.infolist() if not info.is_dir() and is_image(info.filename)
+                    and not any(part.startswith('.') or part == '__MACOSX' for part in info.filename.split('/'))]
+                if not pages:
+                    return 1, f'No images found in {self.book_file}'
+                pages.sort(key=lambda info: natural_key(info.filename))
+                covers = [info for info in pages if posixpath.basename(info.filename).lower().startswith('cover')]
+                info = (covers or pages)[0]
+                self.resolve('cover_from_name' if covers else 'cover_from_first_page')
+                self.cover_image = info.filename
+                if self.too_large(info):
+                    return 1, self.too_large(info)
+                return 0, archive.read(info)
+        except self.archive_errors() as e:
+            return 1, f'Cannot read {self.book_file}: {e}'
+
+class Cbr(Cbz):
+    '''Rar comic book archives, read with the rarfile package (which itself needs unrar or bsdtar)'''
+    def open_archive(self):
+        rarfile = optional_import('rarfile')
+        if rarfile is None:
+            raise OSError('the rarfile package is needed to read cbr files')
+        if isinstance(self.book_data, bytes):
+            return rarfile.RarFile(io.BytesIO(self.book_data))
+        return rarfile.RarFile(self.book_data if self.book_data is not None else self.book_file)
+
+    def archive_errors(self):
+        rarfile = optional_import('rarfile')
+        return (rarfile.Error, OSError) if rarfile else (OSError,)
+
+class Mobi(CoverBook):
+    '''Mobipocket, AZW and AZW3 books: a PalmDB whose first record's EXTH header names the cover among the image records'''
+    def read_cover(self):
+        try:
+            with self.open_book() as book:
+                header = book.read(78)
+                if len(header) < 78 or header[60:68] != b'BOOKMOBI':
+                    return 1, f'Not a mobi file {self.book_file}'
+                count, = struct.unpack('>H', header[76:78])
+                if count == 0:
+                    return 1, f'No records in {self.book_file}'
+                offsets = [struct.unpack('>L', book.read(8)[:4])[0] for _ in range(count)]
+                book.seek(0, os.SEEK_END)
+                offsets.append(book.tell())
+
+                def read_record(number):
+                    if offsets[number + 1] < offsets[number]:
+                        raise ValueError(f'record {number} ends before it starts')
+                    book.seek(offsets[number])
+                    return book.read(offsets[number + 1] - offsets[number])
+
+                record0 = read_record(0)
+                if record0[16:20] != b'MOBI':
+                    return 1, f'No mobi header in {self.book_file}'
+                header_length, = struct.unpack('>L', record0[20:24])
+                first_image, = struct.unpack('>L', record0[0x6c:0x70])
+                exth_flags, = struct.unpack('>L', record0[0x80:0x84])
+                cover_offset = None
+                exth = record0[16 + header_length:]
+                if exth_flags & 0x40 and exth[:4] == b'EXTH':
+                    position = 12
+                    for _ in range(struct.unpack('>L', exth[8:12])[0]):
+                        record_type, record_length = struct.unpack('>LL', exth[position:position + 8])
+                        if record_type == 201: # cover offset
+                            cover_offset, = struct.unpack('>L', exth[position + 8:position + 12])
+                        position += record_length
+                if first_image == 0xffffffff:
+                    return 1, f'No images in {self.book_file}'
+                if cover_offset is not None and cover_offset != 0xffffffff:
+                    number = first_image + cover_offset
+                    self.resolve('cover_from_exth')
+                else:
+                    number = first_image
+                    self.resolve('cover_from_first_image')
+                if number >= count:
+                    return 1, f'Cover record {number} missing from {self.book_file}'
+                size = offsets[number + 1] - offsets[number]
+                max_member_size = config_cfg['max_member_size']
+                if max_member_size and size > max_member_size:
+                    return 1, f'record {number} in {self.book_file} is {size} bytes, over the {max_member_size} byte limit'
+                image_data = read_record(number)
+        except (struct.error, OSError, IndexError, ValueError) as e:
+            return 1, f'Cannot read {self.book_file}: {e}'
+        self.cover_image = image_name(image_data)
+        return 0, image_data
+
+class Fb2(CoverBook):
+    '''FictionBook: the cover page names an image embedded, base64 encoded, in a <binary> element'''
+    def read_cover(self):
+        cover_id = None
+        try:
+            with self.open_book() as book:
+                for _, el in etree.iterparse(book, events=('end',), tag=('{*}image', '{*}binary'), huge_tree=True,
+                        resolve_entities=False, no_network=True):
+                    if etree.QName(el).localname == 'image':
+                        parent = el.getparent()
+                        if cover_id is None and parent is not None and etree.QName(parent).localname == 'coverpage':
+                            cover_id = next((value for key, value in el.attrib.items() if etree.QName(key).localname == 'href'), '').lstrip('#')
+                    elif cover_id and el.get('id') == cover_id:
+                        self.resolve('cover_from_coverpage')
+                        self.cover_image = cover_id
+                        image_data = base64.b64decode(el.text or '')
+                        if not is_image(cover_id):
+                            self.cover_image = image_name(image_data, cover_id)
+                        return 0, image_data
+                    else:
+                        el.clear() # binaries other than the cover are never needed
+        except (etree.XMLSyntaxError, OSError, ValueError) as e:
+            return 1, f'Cannot parse {self.book_file}: {e}'
+        if cover_id is None:
+            return 1, f'No cover page in {self.book_file}'
+        return 1, f'Cover image {cover_id} not found in {self.book_file}'
+
+# format name -> (handler, extensions); the handler's dependencies are imported on first use
+BACKENDS = {
+    'epub': (Epub, ('.epub',)),
+    'pdf': (Pdf, ('.pdf',)),
+    'cbz': (Cbz, ('.cbz',)),
+    'cbr': (Cbr, ('.cbr',)),
+    'mobi': (Mobi, ('.mobi', '.azw', '.azw3', '.prc')),
+    'fb2': (Fb2, ('.fb2',)),
+    }
+
+BOOK_GLOBS = tuple('*' + ext for _, extensions in BACKENDS.values() for ext in extensions)
+
+def detect_format(file_name, header):
+    '''Name the backend for a book from its magic bytes, falling back on its extension'''
+    ext = os.path.splitext(file_name)[1].lower()
+    if header.startswith(b'PK\x03\x04'):
+        if header[30:38] == b'mimetype' and b'application/epub+zip' in header[38:100]:
+            return 'epub'
+        return 'epub' if ext == '.epub' else 'cbz'
+    if header.startswith(b'%PDF'):
+        return 'pdf'
+    if header.startswith(b'Rar!\x1a\x07'):
+        return 'cbr'
+    if header[60:68] == b'BOOKMOBI':
+        return 'mobi'
+    if b'<FictionBook' in header:
+        return 'fb2'
+    return extension_format(file_name)
+
+def extension_format(file_name):
+    '''Name the backend for a book from its extension alone, or None'''
+    ext = os.path.splitext(file_name)[1].lower()
+    return next((name for name, (_, extensions) in BACKENDS.items() if ext in extensions), None)
+
+def read_header(file_name, book_data=None):
+    '''The first bytes of a book, for detect_format'''
+    if isinstance(book_data, bytes):
+        return book_data[:HEADER_SIZE]
+    try:
+        with open(file_name, 'rb') as book:
+            return book.read(HEADER_SIZE)
+    except OSError:
+        return b''
+
+usage = '''Ebook image extractor. 
+    USAGE: python ebook_image_extractor.py [--recursive] [--include GLOB] [--exclude GLOB]
+        [--jobs N [--schedule [--render-jobs N] [--progress SECONDS]] | --async-io N] [--index FILE]
+        [--quality N] [--thumbnail WxH] [--thumbnail-quality N]
+        [--pdf-resolution DPI] [--pdf-max-size WxH] [--gs-command CMD]
+        [--max-member-size BYTES] [--max-pixels N] [--max-memory BYTES]
+        [--dedup DIR] [--output DIR | --output-db FILE] [--metrics FILE] [--metrics-format json|prometheus] [--metrics-interval SECONDS]
+        [--journal FILE [--resume]] [--watch [--poll-interval SECONDS] [--debounce SECONDS]] epub_directory/
     '''
-    args = sys.argv[1:]
-    if len(args) != 1:
+
+def parse_size(size):
+    '''Parse WxH, or a single number for a square box'''
+    width, _, height = size.lower().partition('x')
+    try:
+        return int(width), int(height or width)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid size {size}')
+
+def parse_bytes(size):
+    '''Parse a number of bytes, optionally with a K, M or G suffix'''
+    match = re.fullmatch(r'(\d+)([kmg]?)', size.strip().lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f'invalid size {size}')
+    number, unit = match.groups()
+    return int(number) * {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[unit]
+
+def parse_args(args=None):
+    '''Parse the command line, exiting with status 1 on a usage error'''
+    parser = argparse.ArgumentParser(usage=usage, add_help=False)
+    parser.add_argument('epub_dir')
+    parser.add_argument('-r', '--recursive', action='store_true', help='look for books in subdirectories too')
+    parser.add_argument('--include', action='append', metavar='GLOB', help=f'only process matching files (default {", ".join(BOOK_GLOBS)})')
+    parser.add_argument('--exclude', action='append', metavar='GLOB', help='skip matching files and directories')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--async-io', type=int, default=0, metavar='N', help='number of archives to locate covers in concurrently')
+    parser.add_argument('--schedule', action='store_true', help='start the largest books first, rendering pdfs in a pool of their own')
+    parser.add_argument('--render-jobs', type=int, metavar='N', help='worker processes of the pdf pool (default a quarter of --jobs)')
+    parser.add_argument('--progress', type=float, default=0, metavar='SECONDS', help='with --schedule, report progress and an ETA this often')
+    parser.add_argument('--index', metavar='FILE', help='sqlite file caching cover locations between runs')
+    parser.add_argument('--quality', type=int, default=90, help='jpeg quality of transcoded covers')
+    parser.add_argument('--thumbnail', action='append', type=parse_size, default=[], metavar='WxH', help='also write a thumbnail fitting WxH')
+    parser.add_argument('--thumbnail-quality', type=int, default=85, help='jpeg quality of thumbnails')
+    parser.add_argument('--pdf-resolution', type=int, default=150, metavar='DPI', help='resolution of rendered pdf covers')
+    parser.add_argument('--pdf-max-size', type=parse_size, metavar='WxH', help='bound on the size of rendered pdf covers')
+    parser.add_argument('--gs-command', default='gs', metavar='CMD', help='ghostscript command, used without PyMuPDF')
+    parser.add_argument('--max-member-size', type=parse_bytes, default=256 * 1024 * 1024, metavar='BYTES', help='largest archive member read into memory')
+    parser.add_argument('--max-pixels', type=int, default=25000000, metavar='N', help='decode bigger covers at a reduced scale, or refuse them')
+    parser.add_argument('--max-memory', type=parse_bytes, metavar='BYTES', help='address space limit of each worker process')
+    parser.add_argument('--dedup', metavar='DIR', help='convert identical covers once, hard linking them from DIR')
+    parser.add_argument('--output', metavar='DIR', help='write covers to a sharded tree under DIR instead of beside the books')
+    parser.add_argument('--output-db', metavar='FILE', help='store covers in the sqlite file FILE instead of beside the books')
+    parser.add_argument('--metrics', metavar='FILE', help='write stage timings and counters to FILE')
+    parser.add_argument('--metrics-format', choices=('json', 'prometheus'), default='json')
+    parser.add_argument('--metrics-interval', type=float, default=0, metavar='SECONDS', help='also rewrite the metrics file periodically')
+    parser.add_argument('--journal', metavar='FILE', help='append a json line per book to FILE')
+    parser.add_argument('--resume', action='store_true', help='skip books already in the journal')
+    parser.add_argument('--watch', action='store_true', help='after the initial scan, keep processing new books as they arrive')
+    parser.add_argument('--poll-interval', type=float, default=0, metavar='SECONDS', help='poll for new books instead of using inotify')
+    parser.add_argument('--debounce', type=float, default=2, metavar='SECONDS', help='wait until a new book has been quiet this long')
+    parser.add_argument('-h', '--help', action='store_true')
+    try:
+        options = parser.parse_args(args)
+    except SystemExit:
+        sys.exit(1)
+    if options.help:
+        print(usage)
+        sys.exit(0)
+    if options.jobs < 1 or options.async_io < 0 or (options.output and options.output_db) or (options.resume and not options.journal) \
+            or (options.schedule and options.async_io) or (options.render_jobs is not None and (options.render_jobs < 0 or options.render_jobs >= options.jobs)):
         print(usage)
         sys.exit(1)
-    epub_dir = args[0]
+    return options
+
+def match_globs(name, rel_path, patterns):
+    '''Case-insensitive glob match against either the file name or its path relative to the library'''
+    name, rel_path = name.lower(), rel_path.lower()
+    return any(fnmatch.fnmatchcase(name, p) or fnmatch.fnmatchcase(rel_path, p) for p in patterns)
+
+def iter_ebooks(epub_dir, include=None, exclude=None, recursive=False):
+    '''Yield book paths in the order the directory lists them, using the file type cached in each DirEntry.
+    Only the subdirectories still to visit are held, sorted so the walk is repeatable, and never a whole
+    listing, so time to the first book and memory do not grow with the size of a directory'''
+    include = [p.lower() for p in include or BOOK_GLOBS]
+    exclude = [p.lower() for p in exclude or ()]
+    stack = [epub_dir]
+    while stack:
+        directory = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    rel_path = os.path.relpath(entry.path, epub_dir)
+                    if exclude and match_globs(entry.name, rel_path, exclude):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirs.append(entry.path)
+                    elif entry.is_file() and match_globs(entry.name, rel_path, include):
+                        yield entry.path
+        except OSError as e:
+            print(f'Cannot list {directory}: {e}')
+        stack.extend(sorted(subdirs, reverse=True))
+
+class PollingWatcher:
+    '''Report new or modified books by rescanning the library every interval seconds'''
+    def __init__(self, epub_dir, include=None, exclude=None, recursive=False, interval=10):
+        self.scan_args = epub_dir, include, exclude, recursive
+        self.interval = interval
+        self.snapshot = self.scan()
+        self.next_scan = time.monotonic() + interval
+
+    def scan(self):
+        snapshot = {}
+        for path in iter_ebooks(*self.scan_args):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = st.st_size, st.st_mtime_ns
+        return snapshot
+
+    def changes(self, timeout=None):
+        '''Wait up to timeout seconds (forever if None) and return the books that changed'''
+        wait = self.next_scan - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+        snapshot = self.scan()
+        changed = [path for path, stat in snapshot.items() if self.snapshot.get(path) != stat]
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    '''Report books written or moved into the library, using Linux inotify through ctypes.
+    Should inotify refuse a directory that appears later, say at the fs.inotify.max_user_watches
+    limit, it hands over to a PollingWatcher rather than miss the books put there'''
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, len, followed by len bytes of name
+
+    def __init__(self, epub_dir, include=None, exclude=None, recursive=False, poll_interval=10):
+        self.epub_dir = epub_dir
+        self.include = [p.lower() for p in include or BOOK_GLOBS]
+        self.exclude = [p.lower() for p in exclude or ()]
+        self.recursive = recursive
+        import ctypes.util # only this watcher needs it
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        self.poll_interval = poll_interval
+        self.fallback = None # a PollingWatcher, once inotify has refused a directory
+        try:
+            self.add_directory(epub_dir)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_directory(self, directory):
+        '''Watch directory, and its subdirectories when recursive. Raises OSError if inotify refuses one
+        that still exists, which polling would still see'''
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR): # gone again, and its books with it
+                return
+            raise OSError(error, f'Cannot watch {directory}: {os.strerror(error)}')
+        self.directories[wd] = directory
+        if self.recursive:
+            try:
+                with os.scandir(directory) as it:
+                    subdirs = [e.path for e in it if e.is_dir(follow_symlinks=False) and not self.excluded(e.path)]
+            except OSError:
+                subdirs = []
+            for subdir in subdirs:
+                self.add_directory(subdir)
+
+    def excluded(self, path):
+        return bool(self.exclude) and match_globs(os.path.basename(path), os.path.relpath(path, self.epub_dir), self.exclude)
+
+    def wanted(self, path):
+        return not self.excluded(path) and match_globs(os.path.basename(path), os.path.relpath(path, self.epub_dir), self.include)
+
+    def changes(self, timeout=None):
+        '''Wait up to timeout seconds (forever if None) and return the books that changed'''
+        if self.fallback is not None:
+            return self.fallback.changes(timeout)
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        changed = []
+        while self.fallback is None:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW: # events were lost, so look at everything again
+                    changed.extend(iter_ebooks(self.epub_dir, self.include, self.exclude, self.recursive))
+                    continue
+                if wd not in self.directories:
+                    continue
+                path = os.path.join(self.directories[wd], os.fsdecode(name))
+                if mask & self.IN_ISDIR:
+                    if self.recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO) and not self.excluded(path):
+                        if self.fallback is None:
+                            try:
+                                self.add_directory(path)
+                            except OSError as e:
+                                print(f'{e}, polling instead')
+                                self.fall_back()
+                        changed.extend(iter_ebooks(path, self.include, self.exclude, True)) # some may have landed before the watch
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and self.wanted(path):
+                    changed.append(path)
+        return changed
+
+    def fall_back(self):
+        '''Hand over to a PollingWatcher, whose first scan takes in the books already there'''
+        os.close(self.fd)
+        self.fallback = PollingWatcher(self.epub_dir, self.include, self.exclude, self.recursive, self.poll_interval)
+
+    def close(self):
+        if self.fallback is None:
+            os.close(self.fd)
+
+def make_watcher(epub_dir, include=None, exclude=None, recursive=False, poll_interval=0):
+    '''Use inotify where the platform has it, unless polling is asked for'''
+    if not poll_interval and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(epub_dir, include, exclude, recursive)
+        except (OSError, AttributeError) as e:
+            print(f'inotify is not available ({e}), polling instead')
+    return PollingWatcher(epub_dir, include, exclude, recursive, poll_interval or 10)
+
+def watch_batches(watcher, debounce=2):
+    '''Yield sorted batches of changed books, once each has been quiet for debounce seconds'''
+    pending = {}
+    while True:
+        timeout = None
+        if pending:
+            timeout = max(0, min(pending.values()) + debounce - time.monotonic())
+        for path in watcher.changes(timeout):
+            pending[path] = time.monotonic()
+        now = time.monotonic()
+        ready = sorted(path for path, last_change in pending.items() if now - last_change >= debounce)
+        for path in ready:
+            del pending[path]
+        if ready:
+            yield ready
+
+def get_epub_list(epub_dir=None, include=None, exclude=None, recursive=False):
+    '''Get the epub/pdf full path file names from directory given as an argument, as a generator'''
+    if epub_dir is None:
+        epub_dir = parse_args().epub_dir
     if os.path.isdir(epub_dir):
-        return [os.path.join(epub_dir, f) for f in os.listdir(epub_dir) if f.lower().endswith('.epub') or f.lower().endswith('.pdf')]
+        return iter_ebooks(epub_dir, include, exclude, recursive)
     print(f'Directory Not Found {epub_dir}')
     print(usage)
     sys.exit(1)
 
-def extract_image(file_name):
+def resolve_epub_cover(ebook):
+    '''Find the cover image member of an epub, recording the steps taken in ebook.resolution.
+    Returns None once ebook.cover_image is set, otherwise the reason it could not be found'''
     container_file = 'META-INF/container.xml' #META-INF/container.xml tells us where the opf file is
-    fname, fext = os.path.splitext(file_name)
-    if os.path.isfile(fname + '.jpg'): # skip if jpeg already exists
-        print('Jpeg file already exists for %s' % file_name)
-        return 1, 0, 0 # skipped
-    print(f'Getting image for {file_name}...')
-    if file_name.lower().endswith('.epub'):
-        ebook = Epub(file_name)
-        #status = ebook.get_opf()
-        #if status == 1:
-        #    failed += 1
-        #    continue
-        status, msg = ebook.extract_file(container_file)
-        if status != 0:
-            print(msg)
-            return 0, 0, 1 # failed
+    opf = None
+    with metrics.time('container_parse'):
         container_tree = ebook.parse_xml_file(container_file)
-        opf = ebook.get_opf_from_container(container_tree)
+    with metrics.time('opf_resolution'):
+        if container_tree is not None:
+            opf = ebook.get_opf_from_container(container_tree)
+            opf_source = 'container'
         if not opf:
             opf = ebook.get_opf_from_default()
+            opf_source = 'default'
         if not opf:
             opf = ebook.get_opf_from_contents()
-        if opf:
-            ebook.opf = re.sub('\%20', ' ', opf) # clean up spaces
-            ebook.opf_path = os.path.dirname(ebook.opf)
-            ebook.extract_file(ebook.opf)
-        else:
-            print('Cannot find opf file')
-            return 0, 0, 1 # failed
-        opf_tree = ebook.parse_xml_file(ebook.opf)
-        cover_page = ebook.get_cover_page_from_opf(opf_tree)
-        if not cover_page:
-            print(f'cover page not found for {file_name}')
-            return 0, 0, 1 # failed
-        cover_page = re.sub('\%20', ' ', cover_page) # clean up spaces
-        print(cover_page)
-        cover_page = os.path.join(ebook.opf_path, cover_page)
-        cover_image = ebook.check_if_cover_is_image(cover_page)
-        if cover_image:
-            image_path = ebook.opf_path
+            opf_source = 'contents'
+    if opf:
+        ebook.resolve('opf_from_' + opf_source)
+        ebook.opf = opf
+        ebook.opf_path = posixpath.dirname(ebook.opf)
+    else:
+        return 'Cannot find opf file'
+    with metrics.time('opf_scan'):
+        opf_info = ebook.scan_opf()
+    if opf_info is None:
+        return f'Cannot parse opf file {ebook.opf}'
+    if ebook.get_image_location() != 0:
+        return ebook.error or f'No cover found for {ebook.book_file}'
+    ebook.cover_image = ebook.image
+
+def extract_epub_image(ebook, entry=None):
+    '''Resolve and write the cover of an epub, reading every member through the one open archive.
+    An index entry for an unchanged book, or one from locate_cover, lets us go straight to the image member'''
+    try:
+        ebook.get_archive()
+    except zipfile.BadZipFile:
+        return ebook.reject(f'Bad zip file for {ebook.book_file}')
+    except OSError:
+        return ebook.fail(f'Cannot read {ebook.book_file}')
+    if entry and entry['cover_image']:
+        ebook.opf, ebook.cover_page, ebook.cover_image = entry['opf'], entry['cover_page'], entry['cover_image']
+        if entry.get('resolution'): # located by a reader thread, which counted its steps
+            ebook.resolution = list(entry['resolution'])
         else:
-            status, msg = ebook.extract_file(cover_page)
-            print(status, msg)
-            if status != 0:
-                return 0, 0, 1 # failed
-            cover_tree = ebook.get_cover_tree(cover_page)
-            cover_image = ebook.get_image_from_src(cover_tree)
-            if not cover_image:
-                cover_image = ebook.get_image_from_href(cover_tree)
-            image_path = os.path.dirname(cover_page)
-        if cover_image:
-            ebook.cover_image = ebook.correct_image_path(cover_image, image_path)
-            status = ebook.extract_image()
-            if status == 0:
-                return 0, 1, 0 # created
-            else:
-                return 0, 0, 1 # failed
+            ebook.resolve('cover_from_index')
+        if ebook.extract_image() == 0:
+            return 0, 1, 0 # created
+        print(f'Indexed cover {ebook.cover_image} failed, resolving again')
+    error = resolve_epub_cover(ebook)
+    if error:
+        return ebook.reject(error)
+    ebook.rejected, ebook.error = False, None # whatever the indexed cover did, the book resolves
+    status = ebook.extract_image()
+    if status == 0:
+        return 0, 1, 0 # created
+    else:
         return 0, 0, 1 # failed
 
+class CoverError(Exception):
+    '''Raised by get_cover when a book has no cover that can be extracted'''
+
+CoverResult = collections.namedtuple('CoverResult', 'data media_type width height member resolution')
 
+MEDIA_TYPES = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif',
+    '.webp': 'image/webp', '.svg': 'image/svg+xml',
+    }
+
+def make_cover_result(image_data, member, resolution):
+    '''Fill in the media type and the dimensions from the image header'''
+    image_format, width, height = probe_image_header(image_data[:MAX_PROBE_SIZE]) or (os.path.splitext(member)[1].lower(), None, None)
+    media_type = MEDIA_TYPES.get(image_format, 'application/octet-stream')
+    return CoverResult(image_data, media_type, width, height, member, tuple(resolution))
+
+def get_cover(source):
+    '''Return the cover of an epub or pdf as a CoverResult, without writing anything to disk.
+    source may be a path, a binary file object or the book's bytes. Raises CoverError'''
+    if isinstance(source, (str, os.PathLike)):
+        book_file, book_data = os.fspath(source), None
+        try:
+            with open(book_file, 'rb') as book:
+                header = book.read(HEADER_SIZE)
+        except OSError as e:
+            raise CoverError(f'Cannot read {book_file}: {e}')
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        book_file, book_data = '<bytes>', bytes(source)
+        header = book_data[:HEADER_SIZE]
     else:
-        ebook = Pdf(book_file)
-        status, msg = ebook.extract_file()
+        book_file, book_data = getattr(source, 'name', None), source
+        # a TemporaryFile is named by its descriptor and a SpooledTemporaryFile by None
+        book_file = os.fspath(book_file) if isinstance(book_file, (str, os.PathLike)) else '<file>'
+        position = source.tell()
+        header = source.read(HEADER_SIZE)
+        source.seek(position)
+    book_format = detect_format(book_file, header)
+    if book_format is None:
+        raise CoverError(f'Unrecognised book format {book_file}')
+    if book_format != 'epub':
+        if book_format == 'pdf' and book_data is not None and not isinstance(book_data, bytes):
+            book_data = book_data.read()
+        book = BACKENDS[book_format][0](book_file, book_data)
+        status, image_data = book.read_cover()
         if status != 0:
-            return 0, 0, 1 # failed
+            raise CoverError(image_data)
+        return make_cover_result(image_data, book.cover_image or 'cover.jpg', book.resolution)
+    with Epub(book_file, book_data) as ebook:
+        try:
+            ebook.get_archive()
+        except (zipfile.BadZipFile, OSError):
+            raise CoverError(f'Bad zip file for {book_file}')
+        error = resolve_epub_cover(ebook)
+        if error:
+            raise CoverError(error)
+        entry = ebook.get_entry(ebook.cover_image)
+        if entry is not None and ebook.too_large(entry):
+            raise CoverError(ebook.too_large(entry))
+        image_data = ebook.read_file(ebook.cover_image)
+        if image_data is None:
+            raise CoverError(f'No such file {ebook.cover_image}')
+        return make_cover_result(image_data, ebook.get_entry(ebook.cover_image).filename, ebook.resolution)
+
+COUNTS = {'skipped': (1, 0, 0), 'created': (0, 1, 0), 'failed': (0, 0, 1)}
+
+def process_book(file_name, book_data=None, entry=None):
+    '''Extract the cover of one book, returning a record of what happened for the results journal'''
+    start = time.perf_counter()
+    error = None
+    try:
+        with metrics.time('book'):
+            result, ebook = extract_book_image(file_name, book_data, entry)
+    except Exception as e: # one bad book must not end the run, whichever pipeline it is in
+        print(f'Error extracting image from {file_name}: {e!r}')
+        result, ebook, error = COUNTS['failed'], None, repr(e)
+    status = ('skipped', 'created', 'failed')[result.index(1)]
+    metrics.count(status)
+    return {
+        'book': os.path.abspath(file_name),
+        'status': status,
+        'cover': ebook.cover_image if ebook else None,
+        'error': ebook.error if ebook else error,
+        'seconds': round(time.perf_counter() - start, 4),
+        }
+
+def extract_image(file_name, book_data=None):
+    '''Extract the cover of one book, returning (skipped, created, failed) counts'''
+    return COUNTS[process_book(file_name, book_data)['status']]
+
+def extract_book_image(file_name, book_data=None, entry=None):
+    '''Returns the counts, and the book object if extraction was attempted.
+    entry, shaped like an index entry, is where the cover of an epub was found already'''
+    store = get_store()
+    if store.exists(file_name): # skip if the cover was already extracted
+        print('Jpeg file already exists for %s' % file_name)
+        return (1, 0, 0), None # skipped
+    index = get_index()
+    fingerprint = None
+    if index:
+        fingerprint = get_fingerprint(file_name)
+        if fingerprint:
+            entry = index.lookup(file_name, fingerprint) or entry
+        if entry and entry['outcome'] == 'failed':
+            metrics.count('known_failure')
+            print('Unchanged since a failed attempt, skipping %s' % file_name)
+            return (1, 0, 0), None # skipped
+    print(f'Getting image for {file_name}...')
+    located = None, None, None
+    book_format = detect_format(file_name, read_header(file_name, book_data))
+    try:
+        if book_format == 'epub':
+            with Epub(file_name, book_data) as ebook:
+                result = extract_epub_image(ebook, entry)
+                located = ebook.opf, ebook.cover_page, ebook.cover_image
+        elif book_format is None:
+            ebook = Book(file_name)
+            result = ebook.reject(f'Unrecognised book format {file_name}')
         else:
-            return 0, 1, 0 # created
+            ebook = BACKENDS[book_format][0](file_name, book_data)
+            status, msg = ebook.extract_file()
+            if status != 0:
+                result = ebook.fail(msg)
+            else:
+                print('Successfully extracted image from %s' % file_name)
+                result = 0, 1, 0 # created
+    except MemoryError: # over the --max-memory limit; the book fails, the worker carries on
+        result = ebook.fail(f'Out of memory extracting the cover of {file_name}')
+    if result[1]:
+        try:
+            store.add(file_name)
+        except (OSError, sqlite3.Error) as e:
+            result = ebook.fail(f'Cannot store the cover of {file_name}: {e}')
+    if index and fingerprint:
+        # only a fault in the book is remembered; out of memory, a full disk or a missing converter may not recur
+        index.store(file_name, fingerprint, *located, 'created' if result[1] else 'failed' if ebook.rejected else None)
+    return result, ebook
+
+def extract_image_captured(file_name, book_data=None, entry=None):
+    '''Run process_book in a worker process, capturing its output and metrics so the parent can report them in order'''
+    output = io.StringIO()
+    metrics.reset()
+    with contextlib.redirect_stdout(output):
+        record = process_book(file_name, book_data, entry)
+    return record, output.getvalue(), metrics.snapshot()
+
+def finish_captured(result):
+    '''Print the output of a worker's book, merge its metrics and return its record'''
+    record, output, snapshot = result
+    sys.stdout.write(output)
+    metrics.merge(snapshot)
+    return record
+
+def worker_died(file_name):
+    '''What a worker would have sent back for a book, had it not died under it'''
+    record = {'book': os.path.abspath(file_name), 'status': 'failed', 'cover': None, 'error': 'The worker process died', 'seconds': None}
+    died = Metrics()
+    died.count('failed')
+    return record, f'Worker died extracting the image from {file_name}\n', died.snapshot()
+
+class WorkerPool:
+    '''A process pool that replaces itself when a worker dies, from an OOM kill or a crash in a native library.
+    Each job that was in flight in the broken pool is run once more in a process of its own, so the one that
+    killed it dies alone and is failed, and a bad book takes down neither the run nor the books beside it'''
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.generation = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def submit(self, job, *args):
+        '''Run extract_image_captured on a book'''
+        for _ in range(2):
+            if self.executor is None:
+                self.executor = make_executor(self.workers)
+                self.generation += 1
+            try:
+                future = self.executor.submit(extract_image_captured, job, *args)
+                break
+            except futures.BrokenExecutor:
+                self.replace(self.generation)
+        future.job, future.args, future.generation = job, args, self.generation
+        return future
+
+    def replace(self, generation):
+        '''Drop the broken pool of that generation, unless it has been replaced already'''
+        if generation == self.generation and self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def retry(self, future):
+        '''For a future whose worker died: its job rerun alone, or None if it died alone already'''
+        if future.generation is None:
+            return None
+        self.replace(future.generation)
+        executor = make_executor(1)
+        retry = executor.submit(extract_image_captured, future.job, *future.args)
+        retry.add_done_callback(lambda _: executor.shutdown(wait=False))
+        retry.job, retry.args, retry.generation = future.job, future.args, None
+        return retry
+
+    def result(self, future):
+        '''Wait for a job's captured result, retrying it if its worker dies'''
+        while True:
+            try:
+                return future.result()
+            except futures.BrokenExecutor:
+                retry = self.retry(future)
+                if retry is None:
+                    return worker_died(future.job)
+                future = retry
+
+def make_executor(workers):
+    '''A process pool whose workers take on the parent's configuration'''
+    return futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config_cfg,))
+
+def extract_images_parallel(file_names, jobs, queue_size=None):
+    '''Yield the process_book records of a process pool in input order.
+    At most queue_size books are in flight, so the file list is consumed lazily'''
+    queue_size = queue_size or jobs * 2
+    pending = collections.deque()
+    with WorkerPool(jobs) as pool:
+        for file_name in file_names:
+            pending.append(pool.submit(file_name))
+            while len(pending) >= queue_size:
+                yield finish_captured(pool.result(pending.popleft()))
+        while pending:
+            yield finish_captured(pool.result(pending.popleft()))
+
+def classify_books(file_names):
+    '''Sort books into job classes from their size and extension: pdfs, which are rendered, and the rest.
+    Only a book whose extension names no format is opened for its magic bytes, so the first job is not held
+    up reading every book. Each class is a list of (size, file_name), largest first, so the books that take
+    longest start first and do not leave one worker grinding on after the others are done'''
+    classes = {'pdf': [], 'book': []}
+    for file_name in file_names:
+        try:
+            size = os.path.getsize(file_name)
+        except OSError: # left for the worker to report
+            size = 0
+        book_format = extension_format(file_name) or detect_format(file_name, read_header(file_name))
+        classes['pdf' if book_format == 'pdf' else 'book'].append((size, file_name))
+    for books in classes.values():
+        books.sort(key=lambda book: book[0], reverse=True)
+    return classes
+
+class Progress:
+    '''Books and bytes done per job class, and the ETA that the throughput of each so far gives'''
+    def __init__(self, classes):
+        self.start = time.monotonic()
+        self.total = {job_class: (len(books), sum(size for size, _ in books)) for job_class, books in classes.items() if books}
+        self.done = {job_class: [0, 0] for job_class in self.total}
+
+    def update(self, job_class, books, size):
+        self.done[job_class][0] += books
+        self.done[job_class][1] += size
+
+    def eta(self):
+        '''Seconds until the slowest class is done, or None before every unfinished class has finished a book.
+        The classes run side by side, so each is measured against the whole time elapsed'''
+        elapsed = time.monotonic() - self.start
+        remaining = 0
+        for job_class, (books, size) in self.total.items():
+            done_books, done_size = self.done[job_class]
+            if done_books == books:
+                continue
+            if not done_books or not elapsed:
+                return None
+            # measured in bytes where there are any, since a class mixes short and very long books
+            fraction = done_size / size if done_size else done_books / books
+            remaining = max(remaining, elapsed * (1 - fraction) / fraction)
+        return remaining
+
+    def report(self):
+        elapsed = time.monotonic() - self.start
+        parts = []
+        for job_class, (books, size) in self.total.items():
+            done_books, done_size = self.done[job_class]
+            rate = done_books / elapsed if elapsed else 0
+            parts.append(f'{job_class} {done_books}/{books} ({rate:.1f} books/s, {done_size / elapsed / 1024 ** 2 if elapsed else 0:.1f} MiB/s)')
+        eta = self.eta()
+        return 'progress: ' + ', '.join(parts) + (f', eta {eta:.0f}s' if eta is not None else ', eta unknown')
+
+def extract_images_scheduled(file_names, jobs, render_jobs=None, progress_interval=0):
+    '''Yield the process_book records of the scheduled pipeline, in the order books finish.
+    Pdfs go to a pool of render_jobs processes, by default a quarter of jobs, and the other books to a pool
+    of the rest; with render_jobs 0, or one job, they share a single pool. Each class is started largest first'''
+    classes = classify_books(file_names)
+    if render_jobs is None:
+        render_jobs = jobs // 4 if jobs > 1 else 0
+    render_jobs = min(render_jobs, len(classes['pdf']))
+    if not classes['book']: # nothing for the other pool to do, so the pdfs may have every worker
+        render_jobs = jobs if render_jobs else 0
+    progress = Progress(classes)
+    last_report = time.monotonic()
+    with contextlib.ExitStack() as stack:
+        def make_pool(workers):
+            return stack.enter_context(WorkerPool(workers))
+        book_pool = make_pool(max(1, jobs - render_jobs))
+        render_pool = make_pool(render_jobs) if render_jobs else book_pool
+        sizes = {file_name: size for books in classes.values() for size, file_name in books}
+        queues = [ # (pool, workers, class, jobs left); at most twice the workers of each are in flight
+            (render_pool, render_jobs or jobs, 'pdf', collections.deque(file_name for _, file_name in classes['pdf'])),
+            (book_pool, max(1, jobs - render_jobs), 'book', collections.deque(file_name for _, file_name in classes['book'])),
+            ]
+        running = {}
+        in_flight = collections.Counter()
+        def submit():
+            for pool, workers, job_class, queued in queues:
+                while queued and in_flight[job_class] < workers * 2:
+                    job = queued.popleft()
+                    running[pool.submit(job)] = pool, job_class, job
+                    in_flight[job_class] += 1
+        submit()
+        while running:
+            finished, _ = futures.wait(running, timeout=progress_interval or None, return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                pool, job_class, job = running.pop(future)
+                try:
+                    result = future.result()
+                except futures.BrokenExecutor:
+                    retry = pool.retry(future)
+                    if retry is not None:
+                        running[retry] = pool, job_class, job
+                        continue
+                    result = worker_died(job)
+                in_flight[job_class] -= 1
+                record = finish_captured(result)
+                progress.update(job_class, 1, sizes[job])
+                yield record
+            submit()
+            if progress_interval and time.monotonic() - last_report >= progress_interval:
+                print(progress.report())
+                last_report = time.monotonic()
+    if progress_interval:
+        print(progress.report())
+
+def locate_cover(file_name):
+    '''Find where the cover of an epub still to be extracted lies, reading only the central directory, the
+    container, the opf and perhaps the cover page, then read the image's compressed bytes through so that
+    the worker extracting it finds them cached. Returns an entry like the index's, or None to leave the
+    book to the worker, which resolves it again and reports why if it fails'''
+    if not file_name.lower().endswith('.epub') or get_store().exists(file_name):
+        return None
+    try:
+        with Epub(file_name) as ebook:
+            ebook.get_archive()
+            if resolve_epub_cover(ebook) is not None:
+                return None
+            ebook.warm(ebook.cover_image)
+            return {'opf': ebook.opf, 'cover_page': ebook.cover_page, 'cover_image': ebook.cover_image,
+                'resolution': tuple(ebook.resolution)}
+    except Exception:
+        return None
+
+async def iter_images_async(file_names, concurrency, executor):
+    '''Overlap the reads that locate the covers of up to concurrency epubs, handing each book with its
+    cover's location to a WorkerPool, which then reads only the image. No more of a book than its central
+    directory and a few small members passes through this process, and none is sent to the workers.
+    Results are yielded in input order'''
+    import asyncio # only this pipeline needs it, and it is slow to import
+    loop = asyncio.get_running_loop()
+    readers = futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    async def process(file_name):
+        entry = await loop.run_in_executor(readers, locate_cover, file_name)
+        future = executor.submit(file_name, None, entry)
+        while True:
+            try:
+                return await asyncio.wrap_future(future)
+            except futures.BrokenExecutor:
+                retry = executor.retry(future)
+                if retry is None:
+                    return worker_died(file_name)
+                future = retry
+
+    pending = collections.deque()
+    with readers:
+        for file_name in file_names:
+            pending.append(asyncio.ensure_future(process(file_name)))
+            while len(pending) >= concurrency * 2:
+                yield finish_captured(await pending.popleft())
+        while pending:
+            yield finish_captured(await pending.popleft())
+
+def extract_images_async(file_names, concurrency, jobs=1):
+    '''Yield the process_book records of the asyncio pipeline, for storage where latency rather than CPU dominates'''
+    import asyncio
+    get_store() # opened before the reader threads and the workers exist, rather than raced for by them
+    loop = asyncio.new_event_loop()
+    try:
+        with WorkerPool(jobs) as executor:
+            results = iter_images_async(file_names, concurrency, executor)
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+    finally:
+        loop.close()
+
+def read_journal(journal_file):
+    '''Return the set of books already recorded in a results journal'''
+    books = set()
+    try:
+        with open(journal_file) as journal:
+            for line in journal:
+                try:
+                    books.add(json.loads(line)['book'])
+                except (ValueError, KeyError, TypeError): # a line cut short when the last run died
+                    continue
+    except FileNotFoundError:
+        pass
+    return books
+
+def open_journal(journal_file):
+    '''Open a results journal for appending, ending any line left unfinished by a run that died'''
+    journal = open(journal_file, 'a')
+    if journal.tell() > 0:
+        with open(journal_file, 'rb') as previous:
+            previous.seek(-1, os.SEEK_END)
+            if previous.read(1) != b'\n':
+                journal.write('\n')
+    return journal
+
+def extract_images(file_names, options):
+    '''Yield a record per book from the pipeline chosen on the command line'''
+    if options.async_io:
+        return extract_images_async(file_names, options.async_io, options.jobs)
+    elif options.schedule:
+        return extract_images_scheduled(file_names, options.jobs, options.render_jobs, options.progress)
+    elif options.jobs > 1:
+        return extract_images_parallel(file_names, options.jobs)
+    limit_memory(config_cfg['max_memory']) # books are processed in this process from here on
+    return map(process_book, file_names)
+
+def options_config(options):
+    '''The settings given on a parse_args command line, for configure'''
+    return {
+        'index': options.index,
+        'quality': options.quality,
+        'thumbnails': options.thumbnail,
+        'thumbnail_quality': options.thumbnail_quality,
+        'gsCmd': options.gs_command,
+        'pdf_resolution': options.pdf_resolution,
+        'pdf_max_size': options.pdf_max_size,
+        'max_member_size': options.max_member_size,
+        'max_pixels': options.max_pixels,
+        'max_memory': options.max_memory,
+        'dedup': options.dedup,
+        'output_dir': options.output,
+        'output_db': options.output_db,
+        }
 
 def main():
+    options = parse_args()
+    configure(options_config(options))
     start_time = time.time()
-    skipped = created = failed = 0
-    image_path = None
-    for file_name in get_epub_list():
-        s, c, f = extract_image(file_name)
-        skipped += s
-        created += c
-        failed += f
+    totals = collections.Counter()
+    file_names = get_epub_list(options.epub_dir, options.include, options.exclude, options.recursive)
+    if options.resume:
+        journaled = read_journal(options.journal)
+        def unjournaled(file_names):
+            for file_name in file_names:
+                if os.path.abspath(file_name) in journaled:
+                    totals['skipped'] += 1
+                else:
+                    yield file_name
+        file_names = unjournaled(file_names)
+    journal = open_journal(options.journal) if options.journal else None
+    last_dump = time.time()
+
+    def run(file_names):
+        nonlocal last_dump
+        for record in extract_images(file_names, options):
+            totals[record['status']] += 1
+            if journal:
+                journal.write(json.dumps(record) + '\n')
+                journal.flush()
+            if options.metrics and options.metrics_interval and time.time() - last_dump >= options.metrics_interval:
+                metrics.dump(options.metrics, options.metrics_format)
+                last_dump = time.time()
+
+    watcher = None
+    if options.watch: # set up before the initial scan, so books added during it are not missed
+        watcher = make_watcher(options.epub_dir, options.include, options.exclude, options.recursive, options.poll_interval)
+    try:
+        run(file_names)
+        if watcher:
+            print(f'Watching {options.epub_dir} for new books...')
+            for batch in watch_batches(watcher, options.debounce):
+                store = get_store()
+                for file_name in batch: # a modified book still has the cover of its previous version
+                    store.discard(file_name)
+                run(batch)
+                if options.metrics:
+                    metrics.dump(options.metrics, options.metrics_format)
+    except KeyboardInterrupt:
+        if not watcher:
+            raise
+    finally:
+        if watcher:
+            watcher.close()
+        if journal:
+            journal.close()
+        close_store()
+        close_index()
+    if options.metrics:
+        metrics.dump(options.metrics, options.metrics_format)
 
+    elapsed = time.time() - start_time
+    created, failed, skipped = totals['created'], totals['failed'], totals['skipped']
     print(f'''
     success: {created}
     failures: {failed}
     skipped: {skipped}
+    elapsed: {elapsed:.1f}s ({(created + failed + skipped) / elapsed if elapsed else 0:.1f} books/s)
     ''')
             
 
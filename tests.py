@@ -1,13 +1,96 @@
 #!/usr/bin/env python
 
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import ctypes
+import errno
+import glob
+import io
+import json
 from lxml import etree
 import os
+import random
+import re
+import struct
+import subprocess
+import sys
 import tempfile
+import time
 import unittest
 from unittest import mock
+import zipfile
 
+import benchmark
 import ebook_image_extractor
-from ebook_image_extractor import Epub, Pdf
+from ebook_image_extractor import Epub, Pdf, Image
+
+JPEG_DATA = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00test image\xff\xd9'
+
+CONTAINER_XML = '''<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'''
+
+CONTENT_OPF = '''<?xml version="1.0" encoding="UTF-8"?>
+<package version="2.0" xmlns="http://www.idpf.org/2007/opf">
+    <manifest>
+        <item id="cover" href="Text/cover.xhtml" media-type="application/xhtml+xml"/>
+        <item id="cover-image" href="Images/cover.jpg" media-type="image/jpeg"/>
+    </manifest>
+    <spine><itemref idref="cover"/></spine>
+    <guide><reference type="cover" title="Cover" href="Text/cover.xhtml"/></guide>
+</package>'''
+
+COVER_XHTML = '''<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Cover</title></head>
+<body><div><img src="../Images/cover.jpg" alt="cover"/></div></body></html>'''
+
+def make_epub(book_file, members=None):
+    '''Write a minimal epub with a cover page pointing at a jpeg'''
+    if members is None:
+        members = {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF,
+            'OEBPS/Text/cover.xhtml': COVER_XHTML,
+            'OEBPS/Images/cover.jpg': JPEG_DATA,
+            }
+    with zipfile.ZipFile(book_file, 'w') as epub_archive:
+        epub_archive.writestr('mimetype', 'application/epub+zip')
+        for name, data in members.items():
+            epub_archive.writestr(name, data)
+
+def make_mobi(images, cover_offset=None):
+    '''Write a minimal PalmDB mobi: a header record, one text record and the images, the cover named in EXTH'''
+    exth = b''
+    if cover_offset is not None:
+        exth = b'EXTH' + struct.pack('>LLLLL', 24, 1, 201, 12, cover_offset)
+    mobi_header = bytearray(232)
+    mobi_header[0:8] = b'MOBI' + struct.pack('>L', 232)
+    mobi_header[0x6c - 16:0x70 - 16] = struct.pack('>L', 2) # first image record
+    mobi_header[0x80 - 16:0x84 - 16] = struct.pack('>L', 0x40 if exth else 0)
+    records = [bytes(16) + bytes(mobi_header) + exth, b'text'] + images
+    offset = 78 + 8 * len(records) + 2
+    header = bytearray(78)
+    header[60:68] = b'BOOKMOBI'
+    header[76:78] = struct.pack('>H', len(records))
+    record_list = b''
+    for number, record in enumerate(records):
+        record_list += struct.pack('>LL', offset, number)
+        offset += len(record)
+    return bytes(header) + record_list + b'\0\0' + b''.join(records)
+
+FB2 = '''<?xml version="1.0" encoding="utf-8"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">
+<description><title-info><coverpage><image l:href="#cover.jpg"/></coverpage></title-info></description>
+<body><section><p>text</p><image l:href="#map.png"/></section></body>
+<binary id="map.png" content-type="image/png">iVBORw0KGgo=</binary>
+<binary id="cover.jpg" content-type="image/jpeg">{cover}</binary>
+</FictionBook>'''
+
+def crashing_extract(file_name, *args, extract=ebook_image_extractor.extract_image_captured):
+    if 'crash' in file_name:
+        os._exit(1) # as the OOM killer would
+    return extract(file_name, *args)
 
 class EbookImageExtractorTests(unittest.TestCase):
     def setUp(self):
@@ -21,7 +104,7 @@ class EbookImageExtractorTests(unittest.TestCase):
         test_file4 = tempfile.mkstemp(suffix='.txt', dir=test_dir)
 
         ebook_image_extractor.sys.argv = ['ebook_image_extractor.py', test_dir]
-        file_list = ebook_image_extractor.get_epub_list()
+        file_list = list(ebook_image_extractor.get_epub_list())
         self.assertEqual(len(file_list), 3)
         print(file_list)
 
@@ -38,20 +121,185 @@ class EbookImageExtractorTests(unittest.TestCase):
             file_list = ebook_image_extractor.get_epub_list()
         self.assertEqual(se.exception.code, 1)
 
+    def test_iter_ebooks(self):
+        test_dir = tempfile.mkdtemp()
+        for rel_path in ('a.epub', 'B.PDF', 'notes.txt', 'sub/c.epub', 'sub/deeper/d.pdf', 'skip/e.epub'):
+            path = os.path.join(test_dir, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+        books = ebook_image_extractor.iter_ebooks(test_dir)
+        self.assertNotIsInstance(books, list)
+        self.assertCountEqual([os.path.relpath(f, test_dir) for f in books], ['B.PDF', 'a.epub']) # in listing order
+
+        books = ebook_image_extractor.iter_ebooks(test_dir, recursive=True, exclude=['skip'])
+        books = [os.path.relpath(f, test_dir) for f in books]
+        self.assertCountEqual(books[:2], ['B.PDF', 'a.epub']) # a directory's books before its subdirectories'
+        self.assertEqual(books[2:], ['sub/c.epub', 'sub/deeper/d.pdf'])
+
+        books = ebook_image_extractor.iter_ebooks(test_dir, include=['*.epub'], exclude=['sub/deeper'], recursive=True)
+        self.assertEqual([os.path.relpath(f, test_dir) for f in books], ['a.epub', 'skip/e.epub', 'sub/c.epub'])
+
+    def test_parse_size(self):
+        self.assertEqual(ebook_image_extractor.parse_size('200x300'), (200, 300))
+        self.assertEqual(ebook_image_extractor.parse_size('128'), (128, 128))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            ebook_image_extractor.parse_size('big')
+
+    def test_parse_bytes(self):
+        self.assertEqual(ebook_image_extractor.parse_bytes('4096'), 4096)
+        self.assertEqual(ebook_image_extractor.parse_bytes('256M'), 256 * 1024 * 1024)
+        self.assertEqual(ebook_image_extractor.parse_bytes('2g'), 2 * 1024 ** 3)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            ebook_image_extractor.parse_bytes('lots')
+
+    def test_limit_memory(self):
+        with mock.patch.object(ebook_image_extractor, 'resource') as mock_resource:
+            mock_resource.getrlimit.return_value = (-1, 4096)
+            ebook_image_extractor.limit_memory(None)
+            mock_resource.setrlimit.assert_not_called()
+            ebook_image_extractor.limit_memory(1024)
+            mock_resource.setrlimit.assert_called_with(mock_resource.RLIMIT_AS, (1024, 4096))
+            ebook_image_extractor.limit_memory(8192) # never above the hard limit
+            mock_resource.setrlimit.assert_called_with(mock_resource.RLIMIT_AS, (4096, 4096))
+
+    def test_memory_limit_only_in_workers(self):
+        with mock.patch('ebook_image_extractor.limit_memory') as mock_limit_memory:
+            ebook_image_extractor.configure({'max_memory': 1024})
+            mock_limit_memory.assert_not_called()
+            ebook_image_extractor.init_worker({'max_memory': 1024})
+            mock_limit_memory.assert_called_with(1024)
+        ebook_image_extractor.configure({'max_memory': None})
+
+    def test_locate_cover_out_of_memory(self):
+        book_file = os.path.join(tempfile.mkdtemp(), 'book.epub')
+        make_epub(book_file)
+        with mock.patch('builtins.open', side_effect=MemoryError):
+            self.assertIsNone(ebook_image_extractor.locate_cover(book_file)) # left to the worker
+
+    def test_parse_args(self):
+        options = ebook_image_extractor.parse_args(['--jobs', '4', 'books/'])
+        self.assertEqual(options.epub_dir, 'books/')
+        self.assertEqual(options.jobs, 4)
+        self.assertEqual(ebook_image_extractor.parse_args(['books/']).jobs, 1)
+        options = ebook_image_extractor.parse_args(['-r', '--include', '*.epub', '--exclude', 'tmp', '--exclude', '*.bak', 'books/'])
+        self.assertTrue(options.recursive)
+        self.assertEqual(options.include, ['*.epub'])
+        self.assertEqual(options.exclude, ['tmp', '*.bak'])
+
+        with self.assertRaises(SystemExit) as se:
+            ebook_image_extractor.parse_args(['--jobs', '0', 'books/'])
+        self.assertEqual(se.exception.code, 1)
+
+class WatchTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def test_polling_watcher(self):
+        open(os.path.join(self.test_dir, 'old.epub'), 'w').close()
+        watcher = ebook_image_extractor.PollingWatcher(self.test_dir, interval=0.01)
+        self.assertEqual(watcher.changes(), [])
+        new_file = os.path.join(self.test_dir, 'new.epub')
+        with open(new_file, 'w') as f:
+            f.write('partial')
+        open(os.path.join(self.test_dir, 'notes.txt'), 'w').close()
+        self.assertEqual(watcher.changes(), [new_file])
+        with open(new_file, 'a') as f:
+            f.write('more')
+        self.assertEqual(watcher.changes(), [new_file])
+        self.assertEqual(watcher.changes(), [])
+
+    @unittest.skipUnless(ebook_image_extractor.sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_inotify_watcher(self):
+        watcher = ebook_image_extractor.InotifyWatcher(self.test_dir, exclude=['*.tmp.epub'], recursive=True)
+        try:
+            self.assertEqual(watcher.changes(0), [])
+            new_file = os.path.join(self.test_dir, 'new.epub')
+            make_epub(new_file)
+            make_epub(os.path.join(self.test_dir, 'skip.tmp.epub'))
+            open(os.path.join(self.test_dir, 'notes.txt'), 'w').close()
+            self.assertEqual(watcher.changes(1), [new_file])
+
+            sub_dir = tempfile.mkdtemp(dir=tempfile.gettempdir())
+            make_epub(os.path.join(sub_dir, 'moved.epub'))
+            os.rename(sub_dir, os.path.join(self.test_dir, 'sub'))
+            self.assertEqual(watcher.changes(1), [os.path.join(self.test_dir, 'sub', 'moved.epub')])
+            later_file = os.path.join(self.test_dir, 'sub', 'later.pdf')
+            with open(later_file, 'w') as f:
+                f.write('%PDF')
+            self.assertEqual(watcher.changes(1), [later_file])
+        finally:
+            watcher.close()
+
+    @unittest.skipUnless(ebook_image_extractor.sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_inotify_watcher_falls_back_to_polling(self):
+        def add_watch(*args):
+            ctypes.set_errno(errno.ENOSPC) # fs.inotify.max_user_watches reached
+            return -1
+        output = io.StringIO()
+        with mock.patch.object(ebook_image_extractor.InotifyWatcher, 'add_directory', side_effect=OSError(errno.ENOSPC, 'Cannot watch')), \
+                contextlib.redirect_stdout(output):
+            watcher = ebook_image_extractor.make_watcher(self.test_dir)
+        self.assertIsInstance(watcher, ebook_image_extractor.PollingWatcher)
+        self.assertIn('polling instead', output.getvalue())
+
+        watcher = ebook_image_extractor.InotifyWatcher(self.test_dir, recursive=True, poll_interval=0.01)
+        try:
+            watcher.libc = mock.Mock(inotify_add_watch=add_watch)
+            os.mkdir(os.path.join(self.test_dir, 'sub'))
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(watcher.changes(1), [])
+            self.assertIsInstance(watcher.fallback, ebook_image_extractor.PollingWatcher)
+            self.assertIn(f'Cannot watch {os.path.join(self.test_dir, "sub")}', output.getvalue())
+            later_file = os.path.join(self.test_dir, 'sub', 'later.epub')
+            make_epub(later_file)
+            self.assertEqual(watcher.changes(1), [later_file]) # seen by polling
+        finally:
+            watcher.close()
+
+    def test_watch_batches(self):
+        class FakeWatcher:
+            def __init__(self, events):
+                self.events = events
+            def changes(self, timeout=None):
+                return self.events.pop(0) if self.events else []
+        watcher = FakeWatcher([['b.epub', 'a.epub'], ['b.epub'], [], ['c.pdf']])
+        batches = ebook_image_extractor.watch_batches(watcher, debounce=0)
+        self.assertEqual(next(batches), ['a.epub', 'b.epub'])
+        self.assertEqual(next(batches), ['b.epub'])
+        self.assertEqual(next(batches), ['c.pdf'])
+
+        watcher = FakeWatcher([['a.epub'], ['a.epub']])
+        with mock.patch('ebook_image_extractor.time.monotonic', side_effect=[0, 0, 1, 1, 10]):
+            batches = ebook_image_extractor.watch_batches(watcher, debounce=5)
+            self.assertEqual(next(batches), ['a.epub']) # one batch, after the file went quiet
+
+    def test_watch_reextracts_modified_book(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file)
+        def batches(watcher, debounce):
+            make_epub(book_file, {
+                'META-INF/container.xml': CONTAINER_XML,
+                'OEBPS/content.opf': CONTENT_OPF.replace('href="Text/cover.xhtml"/>', 'href="Images/cover.jpg"/>'),
+                'OEBPS/Images/cover.jpg': JPEG_DATA + b'new',
+                })
+            yield [book_file]
+            raise KeyboardInterrupt
+        ebook_image_extractor.sys.argv = ['ebook_image_extractor.py', '--watch', self.test_dir]
+        output = io.StringIO()
+        with mock.patch('ebook_image_extractor.make_watcher'), mock.patch('ebook_image_extractor.watch_batches', batches), \
+                contextlib.redirect_stdout(output):
+            ebook_image_extractor.main()
+        self.assertIn('success: 2', output.getvalue())
+        with open(os.path.join(self.test_dir, 'book.jpg'), 'rb') as image_file:
+            self.assertEqual(image_file.read(), JPEG_DATA + b'new')
+
 class EpubTests(unittest.TestCase):
     def setUp(self):
         self.test_dir = tempfile.mkdtemp()
         test_file1 = tempfile.mkstemp(suffix='.epub', dir=self.test_dir)
-        ebook_image_extractor.temp_dir = self.test_dir
         self.epub = Epub(test_file1)
 
-    @mock.patch('ebook_image_extractor.zipfile.ZipFile')
-    def test_extract_file(self, mock_zip_file):
-        '''https://gist.github.com/Bergvca/069d50d58b56fba0f9ee695d92ccebde'''
-        self.epub.extract_file('test.opf', directory=self.test_dir)
-
-        mock_zip_file.assert_called()
-
     @mock.patch('ebook_image_extractor.zipfile.ZipFile')
     def test_get_all_contents(self, mock_zip_file):
         #mock_open_file = mock.mock_open()
@@ -65,12 +313,37 @@ class EpubTests(unittest.TestCase):
         self.epub.get_info('OEBPS/content.opf')
         mock_zip_file.assert_called()
 
+    def test_read_file(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file)
+        with mock.patch('ebook_image_extractor.zipfile.ZipFile', wraps=zipfile.ZipFile) as mock_zip_file:
+            with Epub(book_file) as epub:
+                self.assertEqual(epub.read_file('OEBPS/content.opf'), CONTENT_OPF.encode('utf-8'))
+                self.assertEqual(epub.read_file('META-INF/container.xml'), CONTAINER_XML.encode('utf-8'))
+                self.assertIsNone(epub.read_file('missing.opf'))
+        mock_zip_file.assert_called_once() # the archive is only opened once
+
+    def test_get_entry(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file, {'OEBPS/Images/My Cover.JPG': JPEG_DATA, 'OEBPS/Text/cover.xhtml': COVER_XHTML})
+        with Epub(book_file) as epub:
+            for name in ('OEBPS/Images/My Cover.JPG', 'oebps/images/my%20cover.jpg',
+                    'OEBPS/Text/../Images/My%20Cover.jpg', '/OEBPS/./Images/My Cover.JPG'):
+                self.assertEqual(epub.get_entry(name).filename, 'OEBPS/Images/My Cover.JPG')
+            self.assertEqual(epub.get_entry('OEBPS/Text/cover.xhtml#start').filename, 'OEBPS/Text/cover.xhtml')
+            self.assertIsNone(epub.get_entry('OEBPS/Images/other.jpg'))
+
     def test_parse_xml_file(self):
         container_file = 'META-INF/container.xml' #META-INF/container.xml tells us where the opf file is
-        ebook_image_extractor.etree = mock.MagicMock()
-        ebook_image_extractor.etree.parse = mock.MagicMock(return_value='test')
+        self.epub.read_file = mock.MagicMock(return_value=b'<container><rootfiles/></container>')
         container_tree = self.epub.parse_xml_file(container_file)
-        self.assertEqual(container_tree, 'test')
+        self.epub.read_file.assert_called_once_with(container_file)
+        self.assertEqual(container_tree.tag, 'container')
+
+        self.epub.read_file = mock.MagicMock(return_value=b'<container><rootfiles>')
+        self.assertEqual(self.epub.parse_xml_file(container_file).tag, 'container') # recovered
+        self.epub.read_file = mock.MagicMock(return_value=b'not xml')
+        self.assertIsNone(self.epub.parse_xml_file(container_file))
 
     def test_get_opf_from_container(self):
         container_str = '''<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'''
@@ -92,108 +365,6 @@ class EpubTests(unittest.TestCase):
     #def test_get_image_from_cover_page(self):
     #    pass
 
-    def test_get_cover_page_from_opf(self):
-        opf_str = b'''<?xml version="1.0" encoding="UTF-8"?>
-        <package version="2.0" unique-identifier="PrimaryID" xmlns="http://www.idpf.org/2007/opf">
-	<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
-		<dc:title>Galway Girl</dc:title>
-		<dc:language>en-US</dc:language>
-		<dc:identifier id="PrimaryID" opf:scheme="ISBN">9780802147943</dc:identifier>
-		<dc:creator opf:role="aut" opf:file-as="Bruen, Ken">Ken Bruen</dc:creator>
-		<dc:publisher>The Mysterious Press</dc:publisher>
-		<dc:date opf:event="publication">2019</dc:date>
-		<dc:rights>Copyright &#169; 2019 by Ken Bruen</dc:rights>
-		<meta name="cover" content="my_cover_image"/>
-	</metadata>
-	<manifest>
-		<item id="ncx" href="9780802147943_epub_ncx_r1.ncx" media-type="application/x-dtbncx+xml"/>
-		<item id="cvi" href="OEBPS/cvi.htm" media-type="application/xhtml+xml"/>
-		<item id="also" href="OEBPS/also.htm" media-type="application/xhtml+xml"/>
-		<item id="tp" href="OEBPS/tp.htm" media-type="application/xhtml+xml"/>
-		<item id="cop" href="OEBPS/cop.htm" media-type="application/xhtml+xml"/>
-	</manifest>
-	<spine toc="ncx">
-		<itemref idref="cvi"/>
-		<itemref idref="also"/>
-		<itemref idref="tp"/>
-		<itemref idref="cop"/>
-	</spine>
-	<guide>
-		<reference type="text" title="Start" href="OEBPS/tp.htm"/>
-		<reference type="cover" title="Cover" href="OEBPS/cvi.htm"/>
-		<reference type="copyright-page" title="Copyright" href="OEBPS/cop.htm"/>
-		<reference type="toc" title="Table of Contents" href="OEBPS/toc.htm"/>
-	</guide>
-</package>
-        
-        '''
-        opf_tree = etree.fromstring(opf_str)
-        opf_file = self.epub.get_cover_page_from_opf(opf_tree)
-        self.assertEqual(opf_file, 'OEBPS/cvi.htm')
-        opf_str = '''<package version="3.0" unique-identifier="pub-id" xmlns="http://www.idpf.org/2007/opf" dir="ltr" xml:lang="en">
-          <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:opf="http://www.idpf.org/2007/opf">
-            <dc:title id="title">Cinemagritte</dc:title>
-            <meta refines="#title" property="title-type">main</meta>
-            <meta refines="#title" property="display-seq">1</meta>
-            <dc:title id="subtitle">René Magritte within the Frame of Film History, Theory, and Practice</dc:title>
-            <meta refines="#subtitle" property="title-type">subtitle</meta>
-            <meta refines="#subtitle" property="display-seq">2</meta>
-            <dc:title id="collection_title">Contemporary Approaches to Film and Media Series</dc:title>
-            <meta refines="#collection_title" property="title-type">collection</meta>
-            <meta refines="#collection_title" property="display-seq">3</meta>
-            <dc:language id="lang1">en-US</dc:language>
-            <meta refines="#lang1" property="display-seq">1</meta>
-            <dc:creator id="creator1">Lucy Fischer</dc:creator>
-            <meta refines="#creator1" property="file-as">Fischer, Lucy</meta>
-            <meta refines="#creator1" property="role" scheme="marc:relators">aut</meta>
-            <dc:creator id="creator2">Barry Keith Grant</dc:creator>
-            <meta refines="#creator2" property="file-as">Grant, Barry Keith</meta>
-            <meta refines="#creator2" property="role" scheme="marc:relators">edt</meta>
-            <dc:identifier id="pub-id">978-0-8143-4638-9</dc:identifier>
-            <meta refines="#pub-id" property="identifier-type" scheme="xsd:string">unique</meta>
-            <dc:source id="src-id">urn:isbn:978-0-8143-4637-2</dc:source>
-            <dc:publisher>Wayne State University Press</dc:publisher>
-            <dc:description>Cinemagritte: René Magritte within the Frame of Film History, Theory, and Practice investigates the dynamic relationship between the Surrealist modernist artist René Magritte (1898-1967) and the cinema-a topic largely ignored in the annals of film and art criticism. Magritte once said that he used cinema as &quot;a trampoline for the imagination,&quot; but here author Lucy Fischer reverses that process by using Magritte's work as a stimulus for an imaginative examination of film.While Fischer considers direct influences of film on Magritte and Magritte on film, she concentrates primarily on &quot;resonances&quot; of Magritte's work in international cinema-both fiction and documentary, mainstream and experimental. These resonances exist for several reasons. First, Magritte was a lover of cinema and created works as homages to the medium, such as Blue Cinema (1925), which immortalized his childhood movie theater. Second, Magritte's style, though dependent on bizarre juxtapositions, was characterized by surface realism-which ties it to the nature of the photographic and cinematic image. Third, Magritte shares with film a focus on certain significant concepts: the frame, voyeurism, illusionism, the relation between word and image, the face, montage, variable scale, and flexible point of view. Additionally, the volume explores art documentaries concerning Magritte as well as the artist's whimsical amateur &quot;home movies,&quot; made with his wife, Georgette, friends, and Belgian Surrealist associates. The monograph is richly illustrated with images of Magritte's oeuvre as well as film stills from such diverse works as The Eternal Sunshine of the Spotless Mind, Eyes Without a Face, American Splendor, The Blood of a Poet, Zorns Lemma, The Island of Dr. Moreau, The Draughtsman's Contract, and many more. Cinemagritte brings a novel and creative approach to the work of Magritte and both film and art criticism. Students, scholars, and fans of art history and film will enjoy this thoughtful marriage of the two.</dc:description>
-            <dc:date>2019-11-25</dc:date>
-            <meta property="dcterms:modified">2019-09-17T19:51:16Z</meta>
-            <dc:subject>ART009000 Art / Criticism &amp; Theory</dc:subject>
-            <dc:subject>PER004030 Performing Arts / Film &amp; Video / History &amp; Criticism</dc:subject>
-            <dc:rights>All rights reserved</dc:rights>
-            <meta name="cover" content="My_Cover"/>
-          </metadata>
-          <manifest>
-            <item id="toc" properties="nav" href="toc.xhtml" media-type="application/xhtml+xml"/>
-            <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
-            <item href="wsu-fischercinemagritte-0001.xhtml" id="wsu-fischercinemagritte-0001"  media-type="application/xhtml+xml"/>
-            <item href="wsu-fischercinemagritte-0002.xhtml" id="wsu-fischercinemagritte-0002"  media-type="application/xhtml+xml"/>
-            <item href="wsu-fischercinemagritte-0003.xhtml" id="wsu-fischercinemagritte-0003"  media-type="application/xhtml+xml"/>
-            <item href="wsu-fischercinemagritte-0004.xhtml" id="wsu-fischercinemagritte-0004"  media-type="application/xhtml+xml"/>
-            <item href="wsu-fischercinemagritte-0005.xhtml" id="wsu-fischercinemagritte-0005"  media-type="application/xhtml+xml"/>
-            <item href="images/wsu-fischercinemagritte-fig1-1.jpeg" id="imgwsu-fischercinemagritte-fig1-1"  media-type="image/jpeg" />
-            <item href="images/wsu-fischercinemagritte-fig2-2.jpeg" id="imgwsu-fischercinemagritte-fig2-2"  media-type="image/jpeg" />
-            <item href="images/wsu-fischercinemagritte-fig2-3.jpeg" id="imgwsu-fischercinemagritte-fig2-3"  media-type="image/jpeg" />
-            <item href="images/wsu-fischercinemagritte-fig2-1.jpeg" id="imgwsu-fischercinemagritte-fig2-1"  media-type="image/jpeg" />
-            <item href="images/wsu-fischercinemagritte-fig2-4.jpeg" id="imgwsu-fischercinemagritte-fig2-4"  media-type="image/jpeg" />
-            <item href="images/wsu-fischercinemagritte-fig2-5.jpeg" id="imgwsu-fischercinemagritte-fig2-5"  media-type="image/jpeg" />
-            <item href="wsu.css" id="default"  media-type="text/css"/>
-            <item href="fonts/FreeSerifBold.otf" id="FreeSerifBold"  media-type="application/font-sfnt"/>
-            <item href="fonts/FreeSerifBoldItalic.otf" id="FreeSerifBoldItalic"  media-type="application/font-sfnt"/>
-            <item href="fonts/FreeSerifItalic.otf" id="FreeSerifItalic"  media-type="application/font-sfnt"/>
-            <item href="fonts/FreeSerif.otf" id="FreeSerif"  media-type="application/font-sfnt"/>
-          </manifest>
-          <spine toc="ncx">
-            <itemref idref="wsu-fischercinemagritte-0001"/>
-            <itemref idref="wsu-fischercinemagritte-0002"/>
-            <itemref idref="wsu-fischercinemagritte-0003"/>
-            <itemref idref="wsu-fischercinemagritte-0004"/>
-            <itemref idref="wsu-fischercinemagritte-0005"/>
-          </spine>
-        </package>
-        '''
-        opf_tree = etree.fromstring(opf_str)
-        opf_file = self.epub.get_cover_page_from_opf(opf_tree)
-        self.assertEqual(opf_file, 'wsu-fischercinemagritte-0001.xhtml')
-
     def test_check_if_cover_is_image(self):
         cover_image = self.epub.check_if_cover_is_image('test.htm')
         self.assertEqual(cover_image, None)
@@ -222,63 +393,944 @@ class EpubTests(unittest.TestCase):
         #ebook_image_extractor.etree = mock.MagicMock()
         #ebook_image_extractor.etree.HTMLParser = mock.MagicMock()
         #ebook_image_extractor.etree.parse = mock.MagicMock()
-        with mock.patch('ebook_image_extractor.open', mock.mock_open(read_data=cover_html)) as mock_file:
-            cover_tree = self.epub.get_cover_tree('cover_page.html', self.test_dir)
-            mock_file.assert_called_once_with(os.path.join(self.test_dir, 'cover_page.html'))
-            self.assertIsInstance(cover_tree, etree._ElementTree)
+        self.epub.read_file = mock.MagicMock(return_value=cover_html.encode('utf-8'))
+        cover_tree = self.epub.get_cover_tree('OEBPS/cover_page.html')
+        self.epub.read_file.assert_called_once_with('OEBPS/cover_page.html')
+        self.assertIsInstance(cover_tree, etree._Element)
+        self.assertEqual(ebook_image_extractor.all_images(ebook_image_extractor.SRC_ATTRIBUTES(cover_tree)), ['../img/1_1.jpg'])
 
 
-    def test_get_image_from_src(self):
-        cover_html = b'''<?xml version="1.0" encoding="UTF-8"?>
-            <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
-            <html xmlns="http://www.w3.org/1999/xhtml" >
-            <head>
-            <title>Analytic Functions</title>
-            </head>
-            <body style="margin-top: 0px; margin-left: 0px; margin-right: 0px; margin-bottom: 0px; text-align: center; background-color: #FFFFFF;">
-            <div><img src="../img/1_1.jpg" alt="cover" style="height: 100%"/></div>
-            </body>
-            </html>
-            '''
-        cover_tree = etree.fromstring(cover_html)
-        src_file = self.epub.get_image_from_src(cover_tree)
-        print(src_file)
+    def test_href_attributes(self):
+        svg_cover = benchmark.COVER_SVG.format(image_href='../Images/cover.jpg').encode()
+        self.epub.read_file = mock.MagicMock(return_value=svg_cover)
+        cover_tree = self.epub.get_cover_tree('OEBPS/Text/cover.xhtml') # html parser, which keeps xlink:href as is
+        self.assertEqual(ebook_image_extractor.all_images(ebook_image_extractor.SRC_ATTRIBUTES(cover_tree)), [])
+        self.assertEqual(ebook_image_extractor.all_images(ebook_image_extractor.HREF_ATTRIBUTES(cover_tree)), ['../Images/cover.jpg'])
+        self.assertEqual(ebook_image_extractor.all_images(ebook_image_extractor.HREF_ATTRIBUTES(etree.fromstring(svg_cover))), ['../Images/cover.jpg'])
 
-    def test_get_image_from_href(self):
-        pass
+    def test_get_parser(self):
+        parser = ebook_image_extractor.get_parser('html')
+        self.assertIs(ebook_image_extractor.get_parser('html'), parser)
+        self.assertIsNot(ebook_image_extractor.get_parser('xml'), parser)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            self.assertIsNot(pool.submit(ebook_image_extractor.get_parser, 'html').result(), parser)
 
     def test_correct_image_path(self):
         image = '../images/cover.jpg'
         image_path = 'OEBPS/text'
         new_image = self.epub.correct_image_path(image, image_path)
         self.assertEqual(new_image, 'OEBPS/images/cover.jpg')
+        self.assertEqual(self.epub.correct_image_path('../../cover.jpg', 'OEBPS/text/a'), 'OEBPS/cover.jpg')
+        self.assertEqual(self.epub.correct_image_path('cover.jpg', ''), 'cover.jpg')
+
+    def test_stream_file(self):
+        book_file = os.path.join(self.test_dir, 'stream.epub')
+        image_data = os.urandom(3 * ebook_image_extractor.CHUNK_SIZE + 17)
+        with zipfile.ZipFile(book_file, 'w') as epub_archive:
+            epub_archive.writestr('stored.jpg', image_data, zipfile.ZIP_STORED)
+            epub_archive.writestr('deflated.jpg', image_data, zipfile.ZIP_DEFLATED)
+        destination = os.path.join(self.test_dir, 'cover.jpg')
+        with Epub(book_file) as epub:
+            for member in ('stored.jpg', 'deflated.jpg'):
+                epub.stream_file(member, destination)
+                with open(destination, 'rb') as f:
+                    self.assertEqual(f.read(), image_data)
+            with self.assertRaises(KeyError):
+                epub.stream_file('missing.jpg', os.path.join(self.test_dir, 'missing.jpg'))
+        self.assertFalse(any(f.endswith('.part') for f in os.listdir(self.test_dir)))
+
+    def test_open_atomic(self):
+        destination = os.path.join(self.test_dir, 'cover.jpg')
+        with self.assertRaises(ValueError):
+            with ebook_image_extractor.open_atomic(destination) as output:
+                output.write(b'partial')
+                raise ValueError
+        self.assertFalse(any(f.endswith('.part') or f == 'cover.jpg' for f in os.listdir(self.test_dir)))
+        with ebook_image_extractor.open_atomic(destination) as output:
+            output.write(b'complete')
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), b'complete')
 
     def test_get_image_location(self):
-        self.epub.get_image_from_meta = mock.MagicMock(return_value='images/cover.jpg')
-        self.epub.get_image_from_cover_page = mock.MagicMock()
+        self.epub.get_entry = mock.MagicMock(return_value=mock.sentinel.entry)
+        self.epub.scan_opf = mock.MagicMock(return_value={'candidates': {'images/cover.jpg': {'cover_from_meta'}}, 'images': []})
+        self.epub.get_candidates_from_cover_page = mock.MagicMock()
+
+        self.assertEqual(self.epub.get_image_location(), 0)
+
+        self.assertEqual(self.epub.image, 'images/cover.jpg')
+        self.epub.get_candidates_from_cover_page.assert_not_called()
+
+        self.epub.scan_opf = mock.MagicMock(return_value={'candidates': {}, 'images': ['images/back.jpg']})
+        self.epub.get_candidates_from_cover_page = mock.MagicMock(return_value=None)
 
-        self.epub.get_image_location()
+        self.assertEqual(self.epub.get_image_location(), 1)
 
-        self.epub.get_image_from_meta.assert_called()
-        self.epub.get_image_from_cover_page.assert_not_called()
+        self.epub.get_candidates_from_cover_page.assert_called()
 
-        self.epub.get_image_from_meta = mock.MagicMock(return_value=None)
-        self.epub.get_image_from_cover_page = mock.MagicMock(return_value=None)
+    def test_scan_opf(self):
+        book_file = os.path.join(tempfile.mkdtemp(), 'book.epub')
+        def scan(opf):
+            make_epub(book_file, {'OEBPS/content.opf': opf})
+            with Epub(book_file) as epub:
+                epub.opf, epub.opf_path = 'OEBPS/content.opf', 'OEBPS'
+                return epub.scan_opf()
 
-        self.epub.get_image_location()
+        info = scan(CONTENT_OPF.replace('<manifest>', '<metadata><meta name="cover" content="cover-image"/></metadata><manifest>'))
+        self.assertEqual(info['candidates'], {'OEBPS/Images/cover.jpg': {'cover_from_meta'}})
 
-        self.epub.get_image_from_cover_page.assert_called()
-        self.epub.get_image_from_meta.assert_called()
+        info = scan(CONTENT_OPF.replace('media-type="image/jpeg"', 'media-type="image/jpeg" properties="cover-image"')
+            .replace('<guide>', '<guide><reference type="cover" href="Images/cover.jpg"/>'))
+        self.assertEqual(info['candidates'], {'OEBPS/Images/cover.jpg': {'cover_from_properties', 'cover_from_guide'}})
+
+        info = scan(CONTENT_OPF.replace('<manifest>', '<metadata><meta name="cover" content="cover-image"/></metadata><manifest>')
+            .replace('<guide>', '<guide><reference type="cover" href="./Images/Cover.JPG"/>'))
+        self.assertEqual(list(info['candidates'].values()), [{'cover_from_meta', 'cover_from_guide'}]) # one member, however spelt
+
+        info = scan(CONTENT_OPF)
+        self.assertEqual(info['candidates'], {})
+        self.assertEqual(info['images'], ['OEBPS/Images/cover.jpg'])
+        self.assertEqual((info['cover_page'], info['first_page']), ('OEBPS/Text/cover.xhtml', 'OEBPS/Text/cover.xhtml'))
+        info = scan(CONTENT_OPF.split('<guide>')[0] + '</package>') # no guide; the first spine item stands in
+        self.assertEqual((info['cover_page'], info['first_page']), (None, 'OEBPS/Text/cover.xhtml'))
+
+        info = scan(CONTENT_OPF.split('<spine>')[0]) # truncated; what was read is recovered
+        self.assertEqual((info['candidates'], info['first_page']), ({}, None))
+        self.assertIsNone(scan('not xml'))
+
+    @unittest.skipIf(ebook_image_extractor.Image is None, 'Pillow is not installed')
+    def test_choose_cover(self):
+        def image(size):
+            image_file = io.BytesIO()
+            ebook_image_extractor.Image.new('RGB', size).save(image_file, 'JPEG')
+            return image_file.getvalue()
+        book_file = os.path.join(tempfile.mkdtemp(), 'book.epub')
+        opf = CONTENT_OPF.replace('<manifest>', '<metadata><meta name="cover" content="thumb"/></metadata><manifest>').replace('</manifest>',
+            '<item id="thumb" href="Images/thumb.jpg" media-type="image/jpeg"/>'
+            '<item id="front" href="Images/front.jpg" media-type="image/jpeg" properties="cover-image"/></manifest>')
+        make_epub(book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': opf,
+            'OEBPS/Images/thumb.jpg': image((60, 90)),
+            'OEBPS/Images/front.jpg': image((600, 900)),
+            })
+        ebook_image_extractor.metrics.reset()
+        ebook = ebook_image_extractor.Epub(book_file)
+        self.assertIsNone(ebook_image_extractor.resolve_epub_cover(ebook))
+        self.assertEqual(ebook.cover_image, 'OEBPS/Images/front.jpg')
+        self.assertEqual(ebook_image_extractor.metrics.snapshot()['counters']['cover_from_properties'], 1)
+
+        # with nothing declared, the cover page image is preferred to the publisher logo beside it
+        make_epub(book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF,
+            'OEBPS/Text/cover.xhtml': COVER_XHTML.replace('<div>', '<div><img src="../Images/logo.jpg"/>'),
+            'OEBPS/Images/logo.jpg': image((120, 40)),
+            'OEBPS/Images/cover.jpg': image((600, 900)),
+            })
+        ebook = ebook_image_extractor.Epub(book_file)
+        self.assertIsNone(ebook_image_extractor.resolve_epub_cover(ebook))
+        self.assertEqual(ebook.cover_image, 'OEBPS/Images/cover.jpg')
+
+    def test_extract_image_from_meta(self):
+        test_dir = tempfile.mkdtemp()
+        book_file = os.path.join(test_dir, 'book.epub')
+        make_epub(book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF.replace('<manifest>', '<metadata><meta name="cover" content="cover-image"/></metadata><manifest>'),
+            'OEBPS/Images/cover.jpg': JPEG_DATA,
+            })
+        ebook_image_extractor.metrics.reset()
+        with mock.patch.object(Epub, 'get_cover_tree') as mock_get_cover_tree:
+            self.assertEqual(ebook_image_extractor.extract_image(book_file), (0, 1, 0))
+        mock_get_cover_tree.assert_not_called()
+        self.assertEqual(ebook_image_extractor.metrics.snapshot()['counters']['cover_from_meta'], 1)
 
     def test_extract_image(self):
         pass
 
+class ExtractImageTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def test_extract_image_in_memory(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file)
+        with mock.patch('ebook_image_extractor.zipfile.ZipFile', wraps=zipfile.ZipFile) as mock_zip_file:
+            self.assertEqual(ebook_image_extractor.extract_image(book_file), (0, 1, 0))
+        mock_zip_file.assert_called_once() # one archive handle per book
+        with open(os.path.join(self.test_dir, 'book.jpg'), 'rb') as image_file:
+            self.assertEqual(image_file.read(), JPEG_DATA)
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ['book.epub', 'book.jpg'])
+
+        self.assertEqual(ebook_image_extractor.extract_image(book_file), (1, 0, 0))
+
+    def test_extract_image_cover_page_is_image(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF.replace('href="Text/cover.xhtml"/>', 'href="Images/Cover%20Art.JPG"/>'),
+            'OEBPS/images/cover art.jpg': JPEG_DATA,
+            })
+        self.assertEqual(ebook_image_extractor.extract_image(book_file), (0, 1, 0))
+
+    def test_extract_image_checks_header(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF.replace('href="Text/cover.xhtml"/>', 'href="Images/cover.jpg"/>'),
+            'OEBPS/Images/cover.jpg': b'<html>not an image</html>',
+            })
+        record = ebook_image_extractor.process_book(book_file)
+        self.assertEqual(record['error'], f'OEBPS/Images/cover.jpg in {book_file} is not an image')
+
+    def test_extract_image_missing_member(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        opf = CONTENT_OPF.replace('<manifest>', '<metadata><meta name="cover" content="missing"/></metadata><manifest>').replace('</manifest>',
+            '<item id="missing" href="Images/missing.jpg" media-type="image/jpeg"/></manifest>')
+        make_epub(book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': opf,
+            'OEBPS/Text/cover.xhtml': COVER_XHTML,
+            'OEBPS/Images/cover.jpg': JPEG_DATA,
+            })
+        record = ebook_image_extractor.process_book(book_file) # the dangling declaration is passed over for the cover page
+        self.assertEqual((record['status'], record['cover']), ('created', 'OEBPS/Images/cover.jpg'))
+
+        with Epub(book_file) as ebook:
+            ebook.cover_image = 'OEBPS/Images/missing.jpg'
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(ebook.extract_image(), 1)
+        self.assertEqual(ebook.error, f'No such file OEBPS/Images/missing.jpg in {book_file}')
+
+    def test_process_book(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file)
+        record = ebook_image_extractor.process_book(book_file)
+        self.assertEqual(record['book'], book_file)
+        self.assertEqual(record['status'], 'created')
+        self.assertEqual(record['cover'], 'OEBPS/Images/cover.jpg')
+        self.assertIsNone(record['error'])
+        self.assertGreater(record['seconds'], 0)
+
+        make_epub(book_file, {'META-INF/container.xml': CONTAINER_XML})
+        os.remove(os.path.join(self.test_dir, 'book.jpg'))
+        record = ebook_image_extractor.process_book(book_file)
+        self.assertEqual((record['status'], record['error']), ('failed', 'Cannot parse opf file OEBPS/content.opf'))
+
+    def test_journal_and_resume(self):
+        file_names = []
+        for i in range(3):
+            book_file = os.path.join(self.test_dir, f'book{i}.epub')
+            make_epub(book_file)
+            file_names.append(book_file)
+        journal_file = os.path.join(self.test_dir, 'journal.jsonl')
+        with open(journal_file, 'w') as journal:
+            journal.write(json.dumps({'book': file_names[1], 'status': 'failed'}) + '\n')
+            journal.write('{"book": "cut short') # the previous run died mid-line
+        self.assertEqual(ebook_image_extractor.read_journal(journal_file), {file_names[1]})
+
+        ebook_image_extractor.sys.argv = ['ebook_image_extractor.py', '--journal', journal_file, '--resume', self.test_dir]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            ebook_image_extractor.main()
+        self.assertIn('skipped: 1', output.getvalue())
+        self.assertFalse(os.path.isfile(os.path.join(self.test_dir, 'book1.jpg')))
+        with open(journal_file) as journal:
+            lines = journal.read().splitlines()
+        self.assertEqual([json.loads(line)['book'] for line in lines[-2:]], [file_names[0], file_names[2]])
+        self.assertEqual(ebook_image_extractor.read_journal(journal_file), set(file_names))
+
+        with self.assertRaises(SystemExit) as se:
+            ebook_image_extractor.parse_args(['--resume', self.test_dir])
+        self.assertEqual(se.exception.code, 1)
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_extract_image_member_too_large(self):
+        image_file = io.BytesIO()
+        Image.frombytes('RGB', (100, 100), os.urandom(30000)).save(image_file, 'PNG')
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF.replace('href="Text/cover.xhtml"/>', 'href="Images/cover.png"/>'),
+            'OEBPS/Images/cover.png': image_file.getvalue(),
+            })
+        ebook_image_extractor.configure({'max_member_size': 20000})
+        try:
+            record = ebook_image_extractor.process_book(book_file)
+            self.assertEqual(record['status'], 'failed')
+            self.assertTrue(record['error'].endswith('cover.png in %s is %d bytes, over the 20000 byte limit' % (book_file, len(image_file.getvalue()))))
+            with self.assertRaisesRegex(ebook_image_extractor.CoverError, 'over the 20000 byte limit'):
+                ebook_image_extractor.get_cover(book_file)
+        finally:
+            ebook_image_extractor.configure({'max_member_size': 256 * 1024 * 1024})
+
+    def test_extract_image_out_of_memory(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file)
+        with mock.patch('ebook_image_extractor.extract_epub_image', side_effect=MemoryError):
+            record = ebook_image_extractor.process_book(book_file)
+        self.assertEqual((record['status'], record['error']), ('failed', f'Out of memory extracting the cover of {book_file}'))
+
+    def test_extract_image_bad_zip(self):
+        book_file = os.path.join(self.test_dir, 'bad.epub')
+        with open(book_file, 'wb') as f:
+            f.write(b'not a zip file')
+        self.assertEqual(ebook_image_extractor.extract_image(book_file), (0, 0, 1))
+
+    def test_extract_images_parallel(self):
+        file_names = []
+        for i in range(6):
+            book_file = os.path.join(self.test_dir, f'book{i}.epub')
+            make_epub(book_file)
+            file_names.append(book_file)
+        bad_file = os.path.join(self.test_dir, 'bad.epub')
+        with open(bad_file, 'wb') as f:
+            f.write(b'not a zip file')
+        file_names.insert(3, bad_file)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            records = list(ebook_image_extractor.extract_images_parallel(file_names, 2, queue_size=3))
+        self.assertEqual([record['status'] for record in records], ['created'] * 3 + ['failed'] + ['created'] * 3)
+        self.assertEqual([record['book'] for record in records], file_names)
+        self.assertEqual(records[3]['error'], f'Bad zip file for {bad_file}')
+        getting = [line for line in output.getvalue().splitlines() if line.startswith('Getting image')]
+        self.assertEqual(getting, [f'Getting image for {file_name}...' for file_name in file_names])
+        for i in range(6):
+            self.assertTrue(os.path.isfile(os.path.join(self.test_dir, f'book{i}.jpg')))
+
+    def test_extract_images_parallel_worker_dies(self):
+        file_names = []
+        for name in ('book0', 'crash', 'book1', 'book2'):
+            file_names.append(os.path.join(self.test_dir, f'{name}.epub'))
+            make_epub(file_names[-1])
+        output = io.StringIO()
+        with mock.patch('ebook_image_extractor.extract_image_captured', crashing_extract), contextlib.redirect_stdout(output):
+            records = list(ebook_image_extractor.extract_images_parallel(file_names, 2, queue_size=4))
+        self.assertEqual([record['book'] for record in records], file_names)
+        self.assertEqual([record['status'] for record in records], ['created', 'failed', 'created', 'created'])
+        self.assertEqual(records[1]['error'], 'The worker process died')
+        self.assertIn(f'Worker died extracting the image from {file_names[1]}', output.getvalue())
+
+    def test_extract_images_async(self):
+        file_names = []
+        for i in range(5):
+            book_file = os.path.join(self.test_dir, f'book{i}.epub')
+            make_epub(book_file)
+            file_names.append(book_file)
+        bad_file = os.path.join(self.test_dir, 'bad.epub')
+        with open(bad_file, 'wb') as f:
+            f.write(b'not a zip file')
+        file_names.insert(1, bad_file)
+        with open(os.path.join(self.test_dir, 'book4.jpg'), 'wb') as f:
+            f.write(JPEG_DATA)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            records = list(ebook_image_extractor.extract_images_async(file_names, 2))
+        self.assertEqual([record['status'] for record in records], ['created', 'failed'] + ['created'] * 3 + ['skipped'])
+        for i in range(4):
+            self.assertTrue(os.path.isfile(os.path.join(self.test_dir, f'book{i}.jpg')))
+
+    def test_iter_images_async(self):
+        file_names = []
+        for i in range(4):
+            file_names.append(os.path.join(self.test_dir, f'book{i}.epub'))
+            make_epub(file_names[-1])
+        submitted = []
+        def extract(file_name, book_data=None, entry=None):
+            submitted.append((file_name, book_data, entry))
+            return ebook_image_extractor.process_book(file_name, book_data, entry), '', ebook_image_extractor.Metrics().snapshot()
+        async def run():
+            with ebook_image_extractor.WorkerPool(2) as executor:
+                executor.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+                return [record async for record in ebook_image_extractor.iter_images_async(file_names, 2, executor)]
+        with mock.patch('ebook_image_extractor.extract_image_captured', extract), contextlib.redirect_stdout(io.StringIO()):
+            records = asyncio.run(run())
+        self.assertEqual([record['status'] for record in records], ['created'] * 4)
+        for file_name, book_data, entry in submitted:
+            self.assertIsNone(book_data) # books are not read whole and sent to the workers
+            self.assertEqual(entry['cover_image'], 'OEBPS/Images/cover.jpg')
+            self.assertEqual(entry['resolution'], ('opf_from_container', 'image_from_src'))
+
+    def test_locate_cover(self):
+        book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(book_file)
+        entry = ebook_image_extractor.locate_cover(book_file)
+        self.assertEqual((entry['opf'], entry['cover_image']), ('OEBPS/content.opf', 'OEBPS/Images/cover.jpg'))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(ebook_image_extractor.extract_image(book_file), (0, 1, 0))
+        self.assertIsNone(ebook_image_extractor.locate_cover(book_file)) # cover already exists
+        self.assertIsNone(ebook_image_extractor.locate_cover(os.path.join(self.test_dir, 'book.pdf')))
+        bad_file = os.path.join(self.test_dir, 'bad.epub')
+        with open(bad_file, 'wb') as f:
+            f.write(b'not a zip file')
+        self.assertIsNone(ebook_image_extractor.locate_cover(bad_file)) # left to the worker to report
+
+class GetCoverTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(self.book_file)
+
+    def test_get_cover_from_path(self):
+        cover = ebook_image_extractor.get_cover(self.book_file)
+        self.assertEqual(cover.data, JPEG_DATA)
+        self.assertEqual(cover.media_type, 'image/jpeg')
+        self.assertEqual(cover.member, 'OEBPS/Images/cover.jpg')
+        self.assertEqual(cover.resolution, ('opf_from_container', 'image_from_src'))
+        self.assertEqual(os.listdir(self.test_dir), ['book.epub']) # nothing written
+
+    def test_get_cover_from_memory(self):
+        with open(self.book_file, 'rb') as book:
+            book_data = book.read()
+            self.assertEqual(ebook_image_extractor.get_cover(book).data, JPEG_DATA)
+        self.assertEqual(ebook_image_extractor.get_cover(book_data).data, JPEG_DATA)
+        self.assertEqual(ebook_image_extractor.get_cover(io.BytesIO(book_data)).member, 'OEBPS/Images/cover.jpg')
+        for temporary in (tempfile.TemporaryFile(), tempfile.SpooledTemporaryFile()): # named by a descriptor, or None
+            with temporary:
+                temporary.write(book_data)
+                temporary.seek(0)
+                self.assertEqual(ebook_image_extractor.get_cover(temporary).data, JPEG_DATA)
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_get_cover_dimensions(self):
+        image_file = io.BytesIO()
+        Image.new('RGB', (30, 40)).save(image_file, 'PNG')
+        make_epub(self.book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF,
+            'OEBPS/Text/cover.xhtml': COVER_XHTML.replace('cover.jpg', 'cover.png'),
+            'OEBPS/Images/cover.png': image_file.getvalue(),
+            })
+        cover = ebook_image_extractor.get_cover(self.book_file)
+        self.assertEqual((cover.media_type, cover.width, cover.height), ('image/png', 30, 40))
+
+    @unittest.skipIf(ebook_image_extractor.optional_import('pymupdf') is None, 'PyMuPDF is not installed')
+    def test_get_cover_pdf(self):
+        cover = ebook_image_extractor.get_cover(benchmark.make_pdf(1))
+        self.assertEqual(cover.media_type, 'image/jpeg')
+        self.assertEqual(cover.resolution, ('pdf_render',))
+        self.assertTrue(cover.data.startswith(b'\xff\xd8'))
+
+    def test_get_cover_errors(self):
+        with self.assertRaises(ebook_image_extractor.CoverError):
+            ebook_image_extractor.get_cover(b'not a book')
+        with self.assertRaises(ebook_image_extractor.CoverError):
+            ebook_image_extractor.get_cover(os.path.join(self.test_dir, 'missing.epub'))
+        make_epub(self.book_file, {'META-INF/container.xml': CONTAINER_XML})
+        with self.assertRaisesRegex(ebook_image_extractor.CoverError, 'Cannot parse opf file'):
+            ebook_image_extractor.get_cover(self.book_file)
+
+class BackendTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def extract(self, name, data):
+        book_file = os.path.join(self.test_dir, name)
+        with open(book_file, 'wb') as f:
+            f.write(data)
+        record = ebook_image_extractor.process_book(book_file)
+        if record['status'] == 'created':
+            with open(os.path.splitext(book_file)[0] + '.jpg', 'rb') as image_file:
+                self.assertEqual(image_file.read(), JPEG_DATA)
+        return record
+
+    def test_detect_format(self):
+        epub_file = os.path.join(self.test_dir, 'book.bin')
+        make_epub(epub_file)
+        with open(epub_file, 'rb') as f:
+            self.assertEqual(ebook_image_extractor.detect_format('book.bin', f.read(1024)), 'epub') # by its mimetype member
+        self.assertEqual(ebook_image_extractor.detect_format('comic.zip', b'PK\x03\x04' + bytes(40)), 'cbz')
+        self.assertEqual(ebook_image_extractor.detect_format('book.epub', b'PK\x03\x04' + bytes(40)), 'epub')
+        self.assertEqual(ebook_image_extractor.detect_format('book.epub', b'%PDF-1.4'), 'pdf')
+        self.assertEqual(ebook_image_extractor.detect_format('comic', b'Rar!\x1a\x07\x00'), 'cbr')
+        self.assertEqual(ebook_image_extractor.detect_format('book.azw3', make_mobi([])[:1024]), 'mobi')
+        self.assertEqual(ebook_image_extractor.detect_format('book.xml', FB2.encode()[:1024]), 'fb2')
+        self.assertEqual(ebook_image_extractor.detect_format('book.fb2', b''), 'fb2')
+        self.assertIsNone(ebook_image_extractor.detect_format('notes.txt', b'hello'))
+
+    def test_lazy_imports(self):
+        code = 'import sys, ebook_image_extractor; print(sorted(m for m in ("pymupdf", "asyncio", "cairosvg") if m in sys.modules))'
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip(), '[]')
+
+    def test_cbz(self):
+        comic = io.BytesIO()
+        with zipfile.ZipFile(comic, 'w') as archive:
+            for name in ('page10.jpg', 'page2.jpg', '__MACOSX/page1.jpg', 'ComicInfo.xml'):
+                archive.writestr(name, b'not the cover')
+            archive.writestr('page1.jpg', JPEG_DATA)
+        record = self.extract('comic.cbz', comic.getvalue())
+        self.assertEqual((record['status'], record['cover']), ('created', 'page1.jpg'))
+        cover = ebook_image_extractor.get_cover(comic.getvalue())
+        self.assertEqual(cover.resolution, ('cover_from_first_page',))
+
+    def test_cbr_without_rarfile(self):
+        with mock.patch('ebook_image_extractor.optional_import', return_value=None):
+            record = self.extract('comic.cbr', b'Rar!\x1a\x07\x00')
+        self.assertEqual(record['status'], 'failed')
+        self.assertIn('rarfile', record['error'])
+
+    def test_mobi(self):
+        record = self.extract('book.azw3', make_mobi([b'\x89PNG first image', JPEG_DATA], cover_offset=1))
+        self.assertEqual((record['status'], record['cover']), ('created', 'cover.jpg'))
+        cover = ebook_image_extractor.get_cover(make_mobi([JPEG_DATA, b'\x89PNG']))
+        self.assertEqual((cover.data, cover.resolution), (JPEG_DATA, ('cover_from_first_image',)))
+        self.assertEqual(self.extract('bad.mobi', make_mobi([])[:90])['status'], 'failed')
+        empty = bytearray(make_mobi([]))
+        empty[76:78] = b'\0\0' # no records at all
+        with self.assertRaises(ebook_image_extractor.CoverError):
+            ebook_image_extractor.get_cover(bytes(empty))
+
+    def test_fb2(self):
+        record = self.extract('book.fb2', FB2.format(cover=base64.b64encode(JPEG_DATA).decode()).encode())
+        self.assertEqual((record['status'], record['cover']), ('created', 'cover.jpg'))
+        record = self.extract('other.fb2', FB2.replace('id="cover.jpg"', 'id="missing.jpg"').encode())
+        self.assertEqual(record['error'], 'Cover image cover.jpg not found in %s' % os.path.join(self.test_dir, 'other.fb2'))
+
+        entity_file = os.path.join(self.test_dir, 'cover.b64')
+        with open(entity_file, 'w') as f:
+            f.write(base64.b64encode(JPEG_DATA).decode())
+        fb2 = FB2.replace('<FictionBook', '<!DOCTYPE FictionBook [<!ENTITY cover SYSTEM "file://%s">]><FictionBook' % entity_file)
+        try:
+            cover = ebook_image_extractor.get_cover(fb2.format(cover='&cover;').encode())
+        except ebook_image_extractor.CoverError:
+            cover = None
+        self.assertNotEqual(cover and cover.data, JPEG_DATA) # external entities are never read
+
+    def test_unexpected_error(self):
+        with mock.patch('ebook_image_extractor.extract_book_image', side_effect=RuntimeError('boom')), \
+                contextlib.redirect_stdout(io.StringIO()):
+            record = ebook_image_extractor.process_book(os.path.join(self.test_dir, 'book.epub'))
+        self.assertEqual((record['status'], record['error']), ('failed', "RuntimeError('boom')"))
+
+    def test_unrecognised_format(self):
+        record = self.extract('notes.txt', b'hello')
+        self.assertEqual(record['error'], 'Unrecognised book format %s' % os.path.join(self.test_dir, 'notes.txt'))
+
+class OutputStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(self.book_file)
+
+    def tearDown(self):
+        ebook_image_extractor.close_store()
+        ebook_image_extractor.configure({'output_dir': None, 'output_db': None, 'thumbnails': []})
+
+    def test_sharded_store(self):
+        output_dir = os.path.join(self.test_dir, 'covers')
+        ebook_image_extractor.configure({'output_dir': output_dir})
+        self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 1, 0))
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ['book.epub', 'covers']) # nothing written beside the book
+        key = ebook_image_extractor.get_store().key(self.book_file)
+        cover_file = os.path.join(output_dir, key[:2], key[2:4], key + '.jpg')
+        with open(cover_file, 'rb') as image_file:
+            self.assertEqual(image_file.read(), JPEG_DATA)
+
+        os.remove(cover_file)
+        with mock.patch('ebook_image_extractor.os.path.isfile') as mock_isfile:
+            self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (1, 0, 0)) # known from the index
+        mock_isfile.assert_not_called()
+        ebook_image_extractor.get_store().discard(self.book_file)
+        self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 1, 0))
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_blob_store(self):
+        db_file = os.path.join(self.test_dir, 'covers.sqlite')
+        ebook_image_extractor.configure({'output_db': db_file, 'thumbnails': [(60, 90)]})
+        image_file = io.BytesIO()
+        Image.new('RGB', (300, 400), 'red').save(image_file, 'JPEG')
+        make_epub(self.book_file, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF.replace('href="Text/cover.xhtml"/>', 'href="Images/cover.jpg"/>'),
+            'OEBPS/Images/cover.jpg': image_file.getvalue(),
+            })
+        self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 1, 0))
+        self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (1, 0, 0))
+        store = ebook_image_extractor.get_store()
+        self.assertEqual(store.get(self.book_file), image_file.getvalue())
+        with Image.open(io.BytesIO(store.get(self.book_file, '-60x90.jpg'))) as thumbnail:
+            self.assertEqual(thumbnail.size, (60, 80))
+        self.assertEqual(os.listdir(store.directory), []) # spooled covers were moved in
+        self.assertNotIn('book.jpg', os.listdir(self.test_dir))
+
+    def test_inherited_store(self):
+        ebook_image_extractor.configure({'output_db': os.path.join(self.test_dir, 'covers.sqlite')})
+        store = ebook_image_extractor.get_store()
+        self.assertTrue(store.directory.endswith('-%d' % os.getpid())) # a spool per process
+        store.pid = -1 # as seen from a forked worker
+        with mock.patch.object(store, 'close') as mock_close:
+            self.assertIsNot(ebook_image_extractor.get_store(), store)
+            ebook_image_extractor.configure({}) # the worker initializer
+        mock_close.assert_not_called()
+        store.close()
+
+class CoverIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.book_file = os.path.join(self.test_dir, 'book.epub')
+        make_epub(self.book_file)
+        ebook_image_extractor.configure({'index': os.path.join(self.test_dir, 'index.sqlite')})
+
+    def tearDown(self):
+        ebook_image_extractor.configure({'index': None})
+
+    def test_get_fingerprint(self):
+        fingerprint = ebook_image_extractor.get_fingerprint(self.book_file)
+        self.assertEqual(fingerprint[0], os.path.getsize(self.book_file))
+        self.assertEqual(fingerprint, ebook_image_extractor.get_fingerprint(self.book_file))
+        make_epub(self.book_file, {'OEBPS/content.opf': CONTENT_OPF})
+        self.assertNotEqual(fingerprint[2], ebook_image_extractor.get_fingerprint(self.book_file)[2])
+        self.assertIsNone(ebook_image_extractor.get_fingerprint(os.path.join(self.test_dir, 'missing.epub')))
+
+    def test_index_records_cover_location(self):
+        self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 1, 0))
+        fingerprint = ebook_image_extractor.get_fingerprint(self.book_file)
+        entry = ebook_image_extractor.get_index().lookup(self.book_file, fingerprint)
+        self.assertEqual(entry, {'opf': 'OEBPS/content.opf', 'cover_page': 'OEBPS/Text/cover.xhtml',
+            'cover_image': 'OEBPS/Images/cover.jpg', 'outcome': 'created'})
+
+        # with the cover removed, the indexed image member is read directly
+        os.remove(os.path.join(self.test_dir, 'book.jpg'))
+        with mock.patch.object(Epub, 'parse_xml_file') as mock_parse:
+            self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 1, 0))
+        mock_parse.assert_not_called()
+
+    def test_index_stale_cover(self):
+        fingerprint = ebook_image_extractor.get_fingerprint(self.book_file)
+        ebook_image_extractor.get_index().store(self.book_file, fingerprint, 'OEBPS/content.opf', None, 'OEBPS/Images/old.jpg', 'created')
+        with contextlib.redirect_stdout(io.StringIO()):
+            record = ebook_image_extractor.process_book(self.book_file)
+        self.assertEqual((record['status'], record['error']), ('created', None)) # the indexed cover's failure is forgotten
+        self.assertEqual(ebook_image_extractor.get_index().lookup(self.book_file, fingerprint)['cover_image'], 'OEBPS/Images/cover.jpg')
+
+    def test_close_index(self):
+        index = ebook_image_extractor.get_index()
+        ebook_image_extractor.configure({})
+        with self.assertRaises(ebook_image_extractor.sqlite3.ProgrammingError): # closed, and reopened on next use
+            index.lookup(self.book_file, ebook_image_extractor.get_fingerprint(self.book_file))
+        self.assertIsNot(ebook_image_extractor.get_index(), index)
+
+    def test_index_skips_known_failures(self):
+        bad_file = os.path.join(self.test_dir, 'bad.epub')
+        with open(bad_file, 'wb') as f:
+            f.write(b'not a zip file')
+        self.assertEqual(ebook_image_extractor.extract_image(bad_file), (0, 0, 1))
+        self.assertEqual(ebook_image_extractor.extract_image(bad_file), (1, 0, 0))
+
+        with open(bad_file, 'ab') as f: # a changed book is tried again
+            f.write(b'!')
+        self.assertEqual(ebook_image_extractor.extract_image(bad_file), (0, 0, 1))
+
+    def test_index_retries_environmental_failures(self):
+        with mock.patch.object(Epub, 'extract_image', side_effect=MemoryError), contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 0, 1))
+        entry = ebook_image_extractor.get_index().lookup(self.book_file, ebook_image_extractor.get_fingerprint(self.book_file))
+        self.assertIsNone(entry['outcome'])
+        self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 1, 0)) # tried again, say with more memory
+
+@unittest.skipIf(ebook_image_extractor.Image is None, 'Pillow is not installed')
+class WriteCoverTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_name = os.path.join(self.test_dir, 'book')
+
+    def tearDown(self):
+        ebook_image_extractor.configure({'thumbnails': [], 'max_pixels': 25000000})
+
+    def make_image(self, fmt, mode='RGB', size=(300, 400)):
+        image_file = io.BytesIO()
+        Image.new(mode, size, 'red').save(image_file, fmt)
+        return image_file.getvalue()
+
+    def test_write_cover_transcodes_png(self):
+        self.assertEqual(ebook_image_extractor.write_cover(self.make_image('PNG', 'RGBA'), 'cover.PNG', self.base_name), 0)
+        with Image.open(self.base_name + '.jpg') as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, (300, 400))
+
+    def test_write_cover_keeps_jpeg(self):
+        image_data = self.make_image('JPEG')
+        self.assertEqual(ebook_image_extractor.write_cover(image_data, 'cover.jpeg', self.base_name), 0)
+        with open(self.base_name + '.jpg', 'rb') as image_file:
+            self.assertEqual(image_file.read(), image_data)
+
+    def test_write_cover_thumbnails(self):
+        ebook_image_extractor.configure({'thumbnails': [(150, 150), (60, 90)]})
+        self.assertEqual(ebook_image_extractor.write_cover(self.make_image('GIF', 'P'), 'cover.gif', self.base_name), 0)
+        with Image.open(self.base_name + '-150x150.jpg') as image:
+            self.assertEqual(image.size, (112, 150))
+        with Image.open(self.base_name + '-60x90.jpg') as image:
+            self.assertEqual(image.size, (60, 80))
+
+    def test_write_cover_misnamed_png(self):
+        self.assertEqual(ebook_image_extractor.write_cover(self.make_image('PNG'), 'cover.jpg', self.base_name), 0)
+        with Image.open(self.base_name + '.jpg') as image:
+            self.assertEqual(image.format, 'JPEG')
+
+    def test_write_cover_small_jpeg_thumbnail(self):
+        ebook_image_extractor.configure({'thumbnails': [(600, 600)]})
+        image_data = self.make_image('JPEG')
+        with mock.patch('ebook_image_extractor.open_image') as mock_open_image:
+            self.assertEqual(ebook_image_extractor.write_cover(image_data, 'cover.jpg', self.base_name), 0)
+        mock_open_image.assert_not_called()
+        with open(self.base_name + '-600x600.jpg', 'rb') as image_file:
+            self.assertEqual(image_file.read(), image_data)
+
+    def test_probe_image_header(self):
+        for fmt, ext in (('JPEG', '.jpg'), ('PNG', '.png'), ('GIF', '.gif'), ('WEBP', '.webp')):
+            image_data = self.make_image(fmt, size=(123, 45))
+            self.assertEqual(ebook_image_extractor.probe_image_header(image_data[:ebook_image_extractor.PROBE_SIZE]), (ext, 123, 45))
+        self.assertEqual(ebook_image_extractor.probe_image_header(self.make_image('JPEG')[:8]), ('.jpg', None, None))
+        svg = b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg" %s></svg>'
+        self.assertEqual(ebook_image_extractor.probe_image_header(svg % b'width="600px" height="800"'), ('.svg', 600, 800))
+        self.assertEqual(ebook_image_extractor.probe_image_header(svg % b'width="100%" viewBox="0 0 600 800"'), ('.svg', 600, 800))
+        self.assertEqual(ebook_image_extractor.probe_image_header(svg % b'width="100%"'), ('.svg', None, None))
+        self.assertIsNone(ebook_image_extractor.probe_image_header(b'<html><body>not an image</body></html>'))
+
+    def test_open_image_over_pixel_limit(self):
+        ebook_image_extractor.configure({'max_pixels': 10000})
+        image = ebook_image_extractor.open_image(self.make_image('JPEG'), 'cover.jpg')
+        self.assertEqual(image.size, (75, 100)) # decoded at 1/4 scale
+        image.load()
+
+        with self.assertRaises(ValueError):
+            ebook_image_extractor.open_image(self.make_image('PNG'), 'cover.png')
+        self.assertEqual(ebook_image_extractor.write_cover(self.make_image('PNG'), 'cover.png', self.base_name), 1)
+
+    def test_dedup_cover(self):
+        dedup_dir = os.path.join(self.test_dir, 'dedup')
+        ebook_image_extractor.configure({'dedup': dedup_dir, 'thumbnails': [(60, 90)]})
+        members = {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF.replace('href="Text/cover.xhtml"/>', 'href="Images/cover.png"/>'),
+            'OEBPS/Images/cover.png': self.make_image('PNG'),
+            }
+        book_files = [os.path.join(self.test_dir, name) for name in ('a.epub', 'b.epub')]
+        for book_file in book_files:
+            make_epub(book_file, members)
+        ebook_image_extractor.metrics.reset()
+        try:
+            with mock.patch('ebook_image_extractor.write_cover', wraps=ebook_image_extractor.write_cover) as mock_write_cover:
+                for book_file in book_files:
+                    self.assertEqual(ebook_image_extractor.extract_image(book_file), (0, 1, 0))
+            mock_write_cover.assert_called_once() # converted once, linked twice
+            counters = ebook_image_extractor.metrics.snapshot()['counters']
+            self.assertEqual((counters['dedup_miss'], counters['dedup_hit']), (1, 1))
+            for name in ('a.jpg', 'b.jpg', 'a-60x90.jpg', 'b-60x90.jpg'):
+                self.assertEqual(os.stat(os.path.join(self.test_dir, name)).st_nlink, 3) # the store's copy and two books
+            self.assertTrue(os.path.samefile(os.path.join(self.test_dir, 'a.jpg'), os.path.join(self.test_dir, 'b.jpg')))
+        finally:
+            ebook_image_extractor.configure({'dedup': None})
+
+    def test_link_cover_copies_across_file_systems(self):
+        stored = os.path.join(self.test_dir, 'stored.jpg')
+        with open(stored, 'wb') as f:
+            f.write(JPEG_DATA)
+        with mock.patch('ebook_image_extractor.os.link', side_effect=OSError('Invalid cross-device link')):
+            ebook_image_extractor.link_cover(stored, self.base_name + '.jpg')
+        with open(self.base_name + '.jpg', 'rb') as f:
+            self.assertEqual(f.read(), JPEG_DATA)
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ['book.jpg', 'stored.jpg'])
+
+    def test_write_cover_bad_image(self):
+        self.assertEqual(ebook_image_extractor.write_cover(b'not an image', 'cover.png', self.base_name), 1)
+
+class BenchmarkTests(unittest.TestCase):
+    def test_make_corpus(self):
+        test_dir = tempfile.mkdtemp()
+        file_names = benchmark.make_corpus(test_dir, len(benchmark.VARIANTS), large_size=(64, 96))
+        self.assertEqual([os.path.basename(f).split('-', 1)[1] for f in file_names],
+            [variant + ('.pdf' if variant == 'pdf' else '.epub') for variant in benchmark.VARIANTS])
+        with zipfile.ZipFile(file_names[0]) as epub_archive:
+            self.assertIn('content.opf', epub_archive.namelist())
+        with zipfile.ZipFile(file_names[1]) as epub_archive:
+            self.assertNotIn('META-INF/container.xml', epub_archive.namelist())
+
+        other_dir = tempfile.mkdtemp()
+        benchmark.make_corpus(other_dir, 3, large_size=(64, 96))
+        for file_name in os.listdir(other_dir): # the corpus is reproducible
+            with open(os.path.join(test_dir, file_name), 'rb') as a, open(os.path.join(other_dir, file_name), 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_run_benchmark(self):
+        test_dir = tempfile.mkdtemp()
+        file_names = benchmark.make_corpus(test_dir, 4, large_size=(64, 96))
+        results = benchmark.run_benchmark(file_names)
+        self.assertEqual(results['books'], 4)
+        self.assertEqual(results['created'] + results['failed'], 4)
+        for key in ('books_per_second', 'p50_ms', 'p99_ms', 'peak_rss_mb'):
+            self.assertGreater(results[key], 0)
+
+    def test_run_benchmark_pipelines(self):
+        test_dir = tempfile.mkdtemp()
+        file_names = [file_name for file_name in benchmark.make_corpus(test_dir, len(benchmark.VARIANTS), large_size=(64, 96))
+            if file_name.endswith('.epub')]
+        for args in (['-j', '2'], ['-j', '2', '--schedule'], ['--async-io', '2']):
+            for image_file in glob.glob(os.path.join(test_dir, '*.jpg')) + glob.glob(os.path.join(test_dir, '*.png')):
+                os.remove(image_file)
+            results = benchmark.run_benchmark(file_names, ebook_image_extractor.parse_args(args + [test_dir]))
+            self.assertEqual((results['created'], results['failed']), (len(file_names), 0), args)
+
+    def test_declared_cover_variants(self):
+        test_dir = tempfile.mkdtemp()
+        rng = random.Random(0)
+        for variant, step in (('meta_cover', 'cover_from_meta'), ('properties_cover', 'cover_from_properties')):
+            book_file = os.path.join(test_dir, f'{variant}.epub')
+            benchmark.make_epub(book_file, 0, variant, rng)
+            cover = ebook_image_extractor.get_cover(book_file)
+            self.assertEqual((cover.member, cover.resolution[-1]), ('OEBPS/Images/cover.jpg', step))
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = ebook_image_extractor.Metrics()
+
+    def test_observe_and_merge(self):
+        self.metrics.observe('opf_parse', 0.003)
+        self.metrics.observe('opf_parse', 100)
+        self.metrics.count('opf_from_container')
+        other = ebook_image_extractor.Metrics()
+        other.observe('opf_parse', 0.0001)
+        other.count('opf_from_container', 2)
+        self.metrics.merge(other.snapshot())
+
+        stats = json.loads(self.metrics.to_json())
+        self.assertEqual(stats['counters'], {'opf_from_container': 3})
+        self.assertEqual(stats['stages']['opf_parse']['count'], 3)
+        self.assertEqual(stats['stages']['opf_parse']['buckets']['0.0005'], 1)
+        self.assertEqual(stats['stages']['opf_parse']['buckets']['0.005'], 2)
+        self.assertEqual(stats['stages']['opf_parse']['buckets']['30'], 2)
+        self.assertAlmostEqual(stats['stages']['opf_parse']['sum'], 100.0031)
+
+        text = self.metrics.to_prometheus()
+        self.assertIn('ebook_stage_seconds_bucket{stage="opf_parse",le="+Inf"} 3\n', text)
+        self.assertIn('ebook_stage_seconds_count{stage="opf_parse"} 3\n', text)
+        self.assertIn('ebook_events_total{event="opf_from_container"} 3\n', text)
+
+    def test_extract_image_metrics(self):
+        test_dir = tempfile.mkdtemp()
+        book_file = os.path.join(test_dir, 'book.epub')
+        make_epub(book_file)
+        ebook_image_extractor.metrics.reset()
+        ebook_image_extractor.extract_image(book_file)
+        snapshot = ebook_image_extractor.metrics.snapshot()
+        for stage in ('book', 'container_parse', 'opf_resolution', 'opf_scan', 'cover_page_parse', 'image_from_src', 'image_write'):
+            self.assertIn(stage, snapshot['stages'])
+        self.assertEqual(snapshot['counters'], {'opf_from_container': 1, 'image_from_src': 1, 'created': 1})
+
+        ebook_image_extractor.metrics.reset()
+        other_file = os.path.join(test_dir, 'other.epub')
+        make_epub(other_file)
+        os.remove(os.path.join(test_dir, 'book.jpg'))
+        list(ebook_image_extractor.extract_images_parallel([book_file, other_file], 2))
+        self.assertEqual(ebook_image_extractor.metrics.snapshot()['counters']['opf_from_container'], 2)
+
+        metrics_file = os.path.join(test_dir, 'metrics.prom')
+        ebook_image_extractor.metrics.dump(metrics_file, 'prometheus')
+        with open(metrics_file) as f:
+            self.assertTrue(f.read().startswith('# TYPE ebook_stage_seconds histogram'))
+
 class PdfTests(unittest.TestCase):
     def setUp(self):
-        pass
+        self.test_dir = tempfile.mkdtemp()
+        self.book_file = os.path.join(self.test_dir, 'book.pdf')
+        self.pdf = Pdf(self.book_file)
 
+    def tearDown(self):
+        ebook_image_extractor.configure({'pdf_max_size': None})
+
+    @unittest.skipIf(ebook_image_extractor.optional_import('pymupdf') is None, 'PyMuPDF is not installed')
     def test_extract_file(self):
-        pass
+        document = ebook_image_extractor.optional_import('pymupdf').open()
+        document.new_page(width=360, height=540)
+        document.save(self.book_file)
+        document.close()
+
+        ebook_image_extractor.configure({'pdf_max_size': (200, 200)})
+        self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 1, 0))
+        with open(os.path.join(self.test_dir, 'book.jpg'), 'rb') as image_file:
+            image_data = image_file.read()
+        self.assertTrue(image_data.startswith(b'\xff\xd8'))
+        if Image is not None:
+            with Image.open(io.BytesIO(image_data)) as image:
+                self.assertEqual(image.height, 200)
+                self.assertLessEqual(image.width, 134)
+
+    def test_extract_file_bad_pdf(self):
+        with open(self.book_file, 'wb') as f:
+            f.write(b'not a pdf')
+        with mock.patch('ebook_image_extractor.subprocess.run') as mock_run:
+            mock_run.return_value = mock.MagicMock(returncode=1, stdout=b'', stderr=b'error')
+            self.assertEqual(ebook_image_extractor.extract_image(self.book_file), (0, 0, 1))
+
+    def test_render_with_ghostscript(self):
+        with mock.patch('ebook_image_extractor.subprocess.run') as mock_run:
+            mock_run.return_value = mock.MagicMock(returncode=0, stdout=b'jpeg data', stderr=b'')
+            self.assertEqual(self.pdf.render_with_ghostscript(), (0, b'jpeg data'))
+        gsargs = mock_run.call_args[0][0]
+        self.assertEqual(gsargs[0], 'gs')
+        self.assertIn('-r150', gsargs)
+        self.assertIn('-sOutputFile=-', gsargs)
+        self.assertEqual(gsargs[-1], self.book_file)
+
+        with mock.patch('ebook_image_extractor.subprocess.run', side_effect=FileNotFoundError):
+            status, msg = self.pdf.render_with_ghostscript()
+        self.assertEqual(status, 1)
+
+class ScheduleTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.small_epub, self.large_epub, self.pdf = (os.path.join(self.test_dir, name) for name in ('a.epub', 'b.epub', 'c.pdf'))
+        make_epub(self.small_epub)
+        make_epub(self.large_epub, {
+            'META-INF/container.xml': CONTAINER_XML,
+            'OEBPS/content.opf': CONTENT_OPF,
+            'OEBPS/Text/cover.xhtml': COVER_XHTML,
+            'OEBPS/Images/cover.jpg': JPEG_DATA,
+            'OEBPS/padding': os.urandom(100000),
+            })
+        with open(self.pdf, 'wb') as f:
+            f.write(benchmark.make_pdf(1))
+
+    def test_classify_books(self):
+        unnamed_pdf = os.path.join(self.test_dir, 'd.download') # only its magic bytes say it is a pdf
+        with open(unnamed_pdf, 'wb') as f:
+            f.write(benchmark.make_pdf(1))
+        with mock.patch('ebook_image_extractor.read_header', wraps=ebook_image_extractor.read_header) as read_header:
+            classes = ebook_image_extractor.classify_books([self.small_epub, self.pdf, self.large_epub, unnamed_pdf])
+        read_header.assert_called_once_with(unnamed_pdf)
+        self.assertEqual([file_name for _, file_name in classes['book']], [self.large_epub, self.small_epub])
+        self.assertEqual([file_name for _, file_name in classes['pdf']], [self.pdf, unnamed_pdf])
+
+    def test_progress(self):
+        with mock.patch('ebook_image_extractor.time.monotonic', return_value=0):
+            progress = ebook_image_extractor.Progress({'pdf': [(300, 'a.pdf'), (100, 'b.pdf')], 'book': [(10, 'c.epub')]})
+        with mock.patch('ebook_image_extractor.time.monotonic', return_value=10):
+            self.assertIsNone(progress.eta())
+            progress.update('book', 1, 10)
+            progress.update('pdf', 1, 300)
+            self.assertAlmostEqual(progress.eta(), 10 / 3) # a quarter of the pdf bytes left
+            self.assertIn('pdf 1/2', progress.report())
+
+    @unittest.skipIf(ebook_image_extractor.optional_import('pymupdf') is None, 'PyMuPDF is not installed')
+    def test_extract_images_scheduled(self):
+        options = ebook_image_extractor.parse_args(['-j', '2', '--schedule', '--progress', '0.01', self.test_dir])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            records = list(ebook_image_extractor.extract_images(ebook_image_extractor.get_epub_list(self.test_dir), options))
+        self.assertEqual(sorted(record['book'] for record in records), [self.small_epub, self.large_epub, self.pdf])
+        self.assertEqual({record['status'] for record in records}, {'created'})
+        self.assertIn('progress: pdf 1/1', output.getvalue())
+
+    def test_parse_args(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for args in (['--schedule', '--async-io', '4'], ['-j', '4', '--render-jobs', '4'], ['--render-jobs', '-1']):
+                with self.assertRaises(SystemExit):
+                    ebook_image_extractor.parse_args(args + [self.test_dir])
 
 if __name__ == '__main__':
     unittest.main()